@@ -1,33 +1,72 @@
 """Backend LLM wrapper with model-routed providers (OpenAI, Anthropic, Gemini)."""
 from __future__ import annotations
 
+import atexit
 import base64
+import contextlib
+import hashlib
 import html as html_module
+import importlib.metadata
+import io
+import itertools
 import json
 import os
+import random
 import re
 import shutil
+import string
 import struct
 import subprocess
 import tempfile
+import threading
 import time
-import urllib.error
 import urllib.parse
-import urllib.request
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from functools import lru_cache, partial
 from pathlib import Path
-from typing import Any, Callable
+from typing import Any, BinaryIO, Callable, Iterable, Iterator
 
+import httpx
+import orjson
 from openai import OpenAI
 
+try:
+    import h2  # noqa: F401 - presence enables HTTP/2 in httpx
+    _HTTP2 = True
+except ImportError:  # pragma: no cover - HTTP/1.1 keep-alive fallback
+    _HTTP2 = False
+
+try:
+    from PIL import Image
+except ImportError:  # pragma: no cover - Pillow ships with manim
+    Image = None
+
 EventCallback = Callable[[dict[str, Any]], None] | None
+ScreenshotAttachments = tuple[list[str], str]
 
 DEFAULT_MODEL = "gpt-5.2-mini"
 DEFAULT_ANTHROPIC_MODEL = "claude-opus-4-5"
 DEFAULT_GEMINI_MODEL = "gemini-3-flash"
 MAX_TOOL_ROUNDS = 25
+VISION_MAX_EDGE = 1024
+VISION_LOW_DETAIL_MAX_EDGE = 512
+PROACTIVE_VISION_MAX_EDGE = 1536
+VISION_WEBP_QUALITY = 70
+WEBP_MAX_EDGE = 16383  # format limit; used where images must keep their size
 BROWSER_TOOL_TIMEOUT_SECONDS = max(
     30, int(os.environ.get("BROWSER_TOOL_TIMEOUT_SECONDS", "180"))
 ) if os.environ.get("BROWSER_TOOL_TIMEOUT_SECONDS", "").strip().isdigit() else 180
+BROWSER_SESSION_STATE_TTL_SECONDS = 2.0
+HEDGE_PROVIDERS = os.environ.get("IRIS_HEDGE_PROVIDERS", "").strip().lower() in {"1", "true", "yes", "on"}
+try:
+    HEDGE_DELAY_SECONDS = max(0.0, float(os.environ.get("IRIS_HEDGE_DELAY_SECONDS", "2.0")))
+except ValueError:
+    HEDGE_DELAY_SECONDS = 2.0
+SESSION_TITLE_HEDGE_DELAY_SECONDS = 0.6
+SESSION_TITLE_DEADLINE_SECONDS = 1.5
+OPENAI_HTTP_TIMEOUT_SECONDS = 600.0  # the SDK's own default; it also sets per-request timeouts
 DEFAULT_BROWSER_SESSION = str(os.environ.get("IRIS_BROWSER_SESSION") or "iris-main").strip() or "iris-main"
 try:
     ANTHROPIC_MAX_TOKENS = max(
@@ -53,39 +92,159 @@ try:
     )
 except ValueError:
     ANTHROPIC_HTTP_BACKOFF_SECONDS = 1.0
+try:
+    GEMINI_HTTP_RETRIES = max(
+        0, min(5, int(os.environ.get("GEMINI_HTTP_RETRIES", "2")))
+    )
+except ValueError:
+    GEMINI_HTTP_RETRIES = 2
+try:
+    GEMINI_HTTP_BACKOFF_SECONDS = max(
+        0.0, float(os.environ.get("GEMINI_HTTP_BACKOFF_SECONDS", "1.0"))
+    )
+except ValueError:
+    GEMINI_HTTP_BACKOFF_SECONDS = 1.0
 
 _WIDGETS_DIR = Path(__file__).resolve().parent.parent / "widgets"
 _PROMPTS_DIR = Path(__file__).resolve().parent / "prompts"
 _BROWSER_SKILL_PATH = _PROMPTS_DIR / "browser-use-SKILL.md"
+_WIDGET_MANIFEST_PATH = _WIDGETS_DIR / "lib" / "manifest.json"
+_WIDGET_CATALOG_HEADER = "Available library widgets (use `read_widget` to get the full HTML):"
+
+@dataclass(frozen=True, slots=True)
+class _ProviderEnv:
+    """Provider keys and model overrides resolved from the environment."""
+
+    openai_api_key: str
+    openai_vision_model: str
+    anthropic_api_key: str
+    anthropic_model: str
+    gemini_api_key: str
+    proactive_gemini_model: str
+
+
+@lru_cache(maxsize=1)
+def _provider_env() -> _ProviderEnv:
+    """Read provider settings once; app.py loads .env before importing this module.
+
+    Call ``_provider_env.cache_clear()`` after changing these variables at runtime.
+    """
+    env = os.environ
+    return _ProviderEnv(
+        openai_api_key=env.get("OPENAI_API_KEY", "").strip(),
+        openai_vision_model=env.get("OPENAI_VISION_MODEL", "gpt-4.1-mini").strip() or "gpt-4.1-mini",
+        anthropic_api_key=env.get("ANTHROPIC_API_KEY", "").strip(),
+        anthropic_model=env.get("ANTHROPIC_MODEL", DEFAULT_ANTHROPIC_MODEL).strip() or DEFAULT_ANTHROPIC_MODEL,
+        gemini_api_key=env.get("GEMINI_API_KEY", "").strip() or env.get("GOOGLE_API_KEY", "").strip(),
+        proactive_gemini_model=(
+            env.get("PROACTIVE_GEMINI_MODEL", DEFAULT_GEMINI_MODEL).strip() or DEFAULT_GEMINI_MODEL
+        ),
+    )
+
+
+_openai_client_lock = threading.Lock()
+_openai_client_cache: tuple[str, OpenAI] | None = None
+
+
+def _json_loads(data: str | bytes) -> Any:
+    """Parse JSON from text or raw UTF-8 bytes."""
+    return orjson.loads(data)
+
+
+def _json_dumpb(value: Any) -> bytes:
+    """Serialize to compact UTF-8 JSON bytes."""
+    return orjson.dumps(value)
+
+
+def _json_dumpb_with(members: bytes, value: dict[str, Any]) -> bytes:
+    """Serialize `value` as a JSON object led by already-encoded `members`.
+
+    `members` is the inside of an object (no braces), so static parts of a
+    request body can be encoded once and spliced into every request.
+    """
+    tail = _json_dumpb(value)
+    if not members:
+        return tail
+    if tail == b"{}":
+        return b"{" + members + b"}"
+    return b"{" + members + b"," + tail[1:]
+
+
+def _json_dumps(value: Any) -> str:
+    """Serialize to compact JSON text without ASCII-escaping."""
+    return orjson.dumps(value).decode("utf-8")
+
+
+def _openai_client(api_key: str) -> OpenAI:
+    """Return the process-wide OpenAI client so its connection pool is reused.
+
+    The transport is the shared pooled client for the API host, so a key
+    change swaps the SDK wrapper without dropping warm connections.
+    """
+    global _openai_client_cache
+    with _openai_client_lock:
+        if _openai_client_cache is None or _openai_client_cache[0] != api_key:
+            http_client = _http_client("https://api.openai.com", OPENAI_HTTP_TIMEOUT_SECONDS)
+            _openai_client_cache = (api_key, OpenAI(api_key=api_key, http_client=http_client))
+        return _openai_client_cache[1]
+
+
+def _mtime_ns(path: Path) -> int:
+    """Modification time for cache keys; -1 when the file is missing."""
+    try:
+        return path.stat().st_mtime_ns
+    except OSError:
+        return -1
 
 
 def _load_widget_catalog() -> str:
+    """Catalog of library widgets, rebuilt only when the manifest changes."""
+    return _load_widget_catalog_cached(_mtime_ns(_WIDGET_MANIFEST_PATH))
+
+
+@lru_cache(maxsize=4)
+def _load_widget_catalog_cached(manifest_mtime_ns: int) -> str:
     """Build a concise catalog of available library widgets from manifest + meta files."""
-    manifest_path = _WIDGETS_DIR / "lib" / "manifest.json"
-    try:
-        manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
-    except (OSError, json.JSONDecodeError):
+    slugs = _manifest_slugs(manifest_mtime_ns)
+    if slugs is None:
         return "No widget library found."
-
-    slugs = manifest.get("widgets", [])
     if not slugs:
         return "Widget library is empty."
 
-    lines = ["Available library widgets (use `read_widget` to get the full HTML):"]
-    for slug in slugs:
-        meta_path = _WIDGETS_DIR / "lib" / slug / "meta.json"
-        try:
-            meta = json.loads(meta_path.read_text(encoding="utf-8"))
-        except (OSError, json.JSONDecodeError):
-            continue
-        name = meta.get("name", slug)
-        desc = meta.get("description", "")
-        w = meta.get("defaultWidth", "?")
-        h = meta.get("defaultHeight", "?")
-        tags = ", ".join(meta.get("tags", []))
-        lines.append(f"- **{name}** (`{slug}`): {desc} — {w}×{h} [{tags}]")
+    # Cold reads block on the filesystem, so fetch the meta files concurrently;
+    # this runs once per manifest change.
+    with ThreadPoolExecutor(max_workers=min(8, len(slugs)), thread_name_prefix="iris-meta") as pool:
+        loaded = list(zip(slugs, pool.map(_load_widget_meta, slugs)))
+    rows = (
+        f"- **{meta.get('name', slug)}** (`{slug}`): {meta.get('description', '')} — "
+        f"{meta.get('defaultWidth', '?')}×{meta.get('defaultHeight', '?')} "
+        f"[{', '.join(meta.get('tags', ()))}]"
+        for slug, meta in loaded
+        if meta is not None
+    )
+    return "\n".join(itertools.chain((_WIDGET_CATALOG_HEADER,), rows))
 
-    return "\n".join(lines)
+
+@lru_cache(maxsize=4)
+def _manifest_slugs(manifest_mtime_ns: int) -> tuple[str, ...] | None:
+    """Widget slugs listed in the library manifest, or None when it is missing/invalid.
+
+    Only the `widgets` list is kept, so callers share one parse per manifest change.
+    """
+    del manifest_mtime_ns  # cache key only
+    try:
+        manifest = _json_loads(_WIDGET_MANIFEST_PATH.read_bytes())
+    except (OSError, json.JSONDecodeError):
+        return None
+    return tuple(manifest.get("widgets", ()))
+
+
+def _load_widget_meta(slug: str) -> dict[str, Any] | None:
+    """Read one widget's meta.json, or None when missing/invalid."""
+    try:
+        return _json_loads((_WIDGETS_DIR / "lib" / slug / "meta.json").read_bytes())
+    except (OSError, json.JSONDecodeError):
+        return None
 
 
 def _load_browser_skill_markdown() -> str:
@@ -103,14 +262,28 @@ def _load_browser_skill_markdown() -> str:
 
 
 def _build_system_prompt() -> str:
+    """Full system prompt, rebuilt only when the widget manifest or browser skill changes."""
+    return _build_system_prompt_cached(_mtime_ns(_WIDGET_MANIFEST_PATH), _mtime_ns(_BROWSER_SKILL_PATH))
+
+
+@lru_cache(maxsize=4)
+def _build_system_prompt_cached(manifest_mtime_ns: int, skill_mtime_ns: int) -> str:
     """Build the full system prompt with dynamic widget catalog + browser skill."""
-    catalog = _load_widget_catalog()
+    del skill_mtime_ns  # cache key only; the catalog keys on the manifest itself
+    catalog = _load_widget_catalog_cached(manifest_mtime_ns)
     browser_skill = _load_browser_skill_markdown()
-    return (
-        _SYSTEM_PROMPT_TEMPLATE
-        .replace("{widget_catalog}", catalog)
-        .replace("{browser_skill}", browser_skill)
-    )
+    values = {"widget_catalog": catalog, "browser_skill": browser_skill}
+    # Odd segments are placeholder names (the split regex captures them).
+    return "".join([
+        values[segment] if index % 2 else segment
+        for index, segment in enumerate(_SYSTEM_PROMPT_SEGMENTS)
+    ])
+
+
+# The template is full of literal `{ }` (D2/code examples) and `$` (LaTeX), so
+# neither str.format_map nor string.Template can fill it. It is split around
+# the placeholders once at import, so a build is just a join.
+_SYSTEM_PROMPT_PLACEHOLDER_RE = re.compile(r"\{(widget_catalog|browser_skill)\}")
 
 
 _SYSTEM_PROMPT_TEMPLATE = """\
@@ -281,6 +454,7 @@ Every widget goes to exactly one device. Think about what the user is doing and
 - If you return text, it should be only the final content the user needs (for math, emit only the formula/steps).
 \
 """
+_SYSTEM_PROMPT_SEGMENTS = tuple(_SYSTEM_PROMPT_PLACEHOLDER_RE.split(_SYSTEM_PROMPT_TEMPLATE))
 
 def _tool_call_info(name: str, args: dict) -> dict:
     """Build a compact info dict for a tool invocation."""
@@ -315,7 +489,7 @@ def _attach_tool_call_result(tool_call: dict[str, Any], raw_result: Any) -> None
         trimmed = raw_result.strip()
         if trimmed.startswith("{") or trimmed.startswith("["):
             try:
-                parsed = json.loads(trimmed)
+                parsed = _json_loads(trimmed)
             except json.JSONDecodeError:
                 parsed = raw_result
 
@@ -331,19 +505,171 @@ def _compact_tool_result(value: Any, *, max_chars: int = 3000) -> Any:
 
     if isinstance(value, (dict, list)):
         try:
-            serialized = json.dumps(value, ensure_ascii=False)
+            serialized = _json_dumpb(value)
         except Exception:
             return str(value)[:max_chars] + ("... [truncated]" if len(str(value)) > max_chars else "")
         if len(serialized) <= max_chars:
             return value
         return {
             "truncated": True,
-            "preview": serialized[:max_chars] + "... [truncated]",
+            "preview": serialized.decode("utf-8")[:max_chars] + "... [truncated]",
         }
 
     return value
 
 
+# Local tools run on a shared pool. Browser tasks run there too, serialized
+# per browser-use session by _browser_session_lock.
+_TOOL_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="iris-tool")
+
+
+@dataclass(slots=True)
+class _ToolOutcome:
+    """Provider-neutral result of one tool call."""
+
+    ok: bool
+    summary: str
+    result: Any
+    content: str
+    widget: dict[str, Any] | None = None
+
+
+def _dispatch_tool(
+    name: str,
+    args: dict[str, Any],
+    *,
+    screenshots: dict[str, bytes] | None,
+    user_message: str,
+) -> _ToolOutcome:
+    """Execute a tool call. Emits no events, so it is safe on a worker thread."""
+    handler = _TOOL_HANDLERS.get(name)
+    if handler is None:
+        return _ToolOutcome(
+            ok=False,
+            summary="Unsupported tool",
+            result={"ok": False, "error": f"Unsupported tool '{name}'."},
+            content=f"Unsupported tool '{name}'.",
+        )
+    return handler(args, screenshots=screenshots, user_message=user_message)
+
+
+def _tool_push_widget(args: dict[str, Any], **_: Any) -> _ToolOutcome:
+    widget = _normalize_widget_args(args)
+    return _ToolOutcome(
+        ok=True,
+        summary=f"Widget '{widget['widget_id']}' → {widget['target']}",
+        result={
+            "ok": True,
+            "widget_id": widget["widget_id"],
+            "target": widget["target"],
+            "width": widget["width"],
+            "height": widget["height"],
+        },
+        content=(
+            f"Widget '{widget['widget_id']}' created "
+            f"({widget['width']}x{widget['height']}) at "
+            f"{widget['coordinate_space']} "
+            f"({widget['x']}, {widget['y']}) anchor={widget['anchor']}."
+        ),
+        widget=widget,
+    )
+
+
+def _tool_read_screenshot(args: dict[str, Any], **_: Any) -> _ToolOutcome:
+    analysis = _handle_read_screenshot(args)
+    return _ToolOutcome(ok=True, summary="Screenshot analyzed", result=analysis, content=analysis)
+
+
+def _tool_read_widget(args: dict[str, Any], **_: Any) -> _ToolOutcome:
+    result = _handle_read_widget(args)
+    return _ToolOutcome(ok=True, summary="Widget loaded", result=result, content=result)
+
+
+def _tool_run_browser_task(
+    args: dict[str, Any],
+    *,
+    screenshots: dict[str, bytes] | None,
+    user_message: str,
+) -> _ToolOutcome:
+    # The payload dict is kept as the result so trajectories and Gemini
+    # responses use it as-is; only the model-facing content is serialized.
+    session_name = str(args.get("session") or "").strip() or DEFAULT_BROWSER_SESSION
+    with _browser_session_lock(session_name):
+        payload = _run_browser_task(args, screenshots=screenshots, user_message=user_message)
+    return _ToolOutcome(
+        ok=True,
+        summary="Browser task completed",
+        result=payload,
+        content=_json_dumps(payload),
+    )
+
+
+_TOOL_HANDLERS: dict[str, Callable[..., _ToolOutcome]] = {
+    "push_widget": _tool_push_widget,
+    "read_screenshot": _tool_read_screenshot,
+    "read_widget": _tool_read_widget,
+    "run_browser_task": _tool_run_browser_task,
+}
+
+
+# Read-only tools that may start as soon as their arguments arrive, before
+# the rest of the turn has streamed in.
+_SPECULATIVE_TOOLS = frozenset({"read_widget", "read_screenshot"})
+
+
+# Widget types whose push is pure-CPU normalization. Diagram and animation
+# pushes shell out to d2/manim, so they stay on the pool where several renders
+# in one round overlap.
+_INLINE_WIDGET_TYPES = frozenset({"html", "document"})
+
+
+def _runs_inline(name: str, args: Any) -> bool:
+    """True for calls that finish in microseconds, where a pool handoff costs more than the call."""
+    return (
+        name == "push_widget"
+        and isinstance(args, dict)
+        and str(args.get("type") or "html").strip().lower() in _INLINE_WIDGET_TYPES
+    )
+
+
+def _submit_tool(name: str, args: dict[str, Any], **kwargs: Any) -> Future[_ToolOutcome]:
+    """Schedule a tool call on the tool pool, or run it inline when that is cheaper.
+
+    I/O-bound calls in one round overlap on the pool; callers collect the
+    futures in call order, so results keep the model's ordering.
+    """
+    if _runs_inline(name, args):
+        future: Future[_ToolOutcome] = Future()
+        try:
+            future.set_result(_dispatch_tool(name, args, **kwargs))
+        except Exception as exc:
+            future.set_exception(exc)
+        return future
+    return _TOOL_EXECUTOR.submit(_dispatch_tool, name, args, **kwargs)
+
+
+class _ToolResultDeduper:
+    """Replace repeated large tool results in one conversation with a back-reference.
+
+    The model already has the earlier copy in context, so re-sending it on
+    every later round only inflates the request.
+    """
+
+    MIN_CHARS = 1024
+
+    def __init__(self) -> None:
+        self._seen: dict[bytes, str] = {}
+
+    def content(self, ref: str, text: str) -> str:
+        if len(text) < self.MIN_CHARS:
+            return text
+        digest = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+        earlier = self._seen.setdefault(digest, ref)
+        if earlier == ref:
+            return text
+        return f"(Identical to the result of tool call {earlier} above.)"
+
+
 TOOLS = [
     {
         "type": "function",
@@ -543,20 +869,33 @@ def run(
     """Run agent routed by model/provider, with compatibility fallback."""
     chosen_model = (model or "").strip() or DEFAULT_MODEL
     provider = _provider_for_model(chosen_model)
+    screenshots = screenshots or None
+    inputs: dict[str, Any] = {
+        "screenshots": screenshots,
+        "attachments": _screenshot_attachments(screenshots),
+    }
+    shared: dict[str, Any] = {**inputs, "on_event": on_event}
 
     if provider == "gemini":
         resolved = _resolve_gemini_model(chosen_model)
-        return _run_gemini(messages, user_message, model=resolved, screenshots=screenshots, on_event=on_event)
+        return _run_gemini(messages, user_message, model=resolved, **shared)
 
     if provider == "anthropic":
-        return _run_anthropic(messages, user_message, model=_resolve_anthropic_model(chosen_model), screenshots=screenshots, on_event=on_event)
+        return _run_anthropic(messages, user_message, model=_resolve_anthropic_model(chosen_model), **shared)
+
+    if HEDGE_PROVIDERS:
+        openai_attempt = ("OpenAI", partial(_run_openai, messages, user_message, model=chosen_model, **inputs))
+        anthropic_attempt = ("Anthropic", partial(_run_anthropic, messages, user_message, model=None, **inputs))
+        if provider == "openai":
+            return _run_hedged([openai_attempt, anthropic_attempt], on_event=on_event)
+        return _run_hedged([anthropic_attempt, openai_attempt], on_event=on_event)
 
     if provider == "openai":
         try:
-            return _run_openai(messages, user_message, model=chosen_model, screenshots=screenshots, on_event=on_event)
+            return _run_openai(messages, user_message, model=chosen_model, **shared)
         except Exception as openai_exc:
             try:
-                return _run_anthropic(messages, user_message, model=None, screenshots=screenshots, on_event=on_event)
+                return _run_anthropic(messages, user_message, model=None, **shared)
             except Exception as anthropic_exc:
                 raise RuntimeError(
                     f"OpenAI failed: {openai_exc}; Anthropic fallback failed: {anthropic_exc}"
@@ -565,12 +904,12 @@ def run(
     # Unknown alias fallback for compatibility.
     anthropic_error: Exception | None = None
     try:
-        return _run_anthropic(messages, user_message, model=None, screenshots=screenshots, on_event=on_event)
+        return _run_anthropic(messages, user_message, model=None, **shared)
     except Exception as exc:
         anthropic_error = exc
 
     try:
-        return _run_openai(messages, user_message, model=chosen_model, screenshots=screenshots, on_event=on_event)
+        return _run_openai(messages, user_message, model=chosen_model, **shared)
     except Exception as openai_exc:
         if anthropic_error is not None:
             raise RuntimeError(
@@ -579,72 +918,238 @@ def run(
         raise
 
 
-def _build_screenshot_label(screenshots: dict[str, bytes]) -> str:
+class _HedgeLost(Exception):
+    """Raised into a hedged attempt once another attempt owns the run."""
+
+
+class _HedgedEventRelay:
+    """Let exactly one hedged attempt run tools and reach the client.
+
+    Each attempt's events are held back until it commits: at its first tool
+    call (the event precedes the tool run) or when it returns first. From then
+    on the owner's events pass straight through, and any other attempt is
+    stopped with _HedgeLost at its next event, so side-effecting tools never
+    run twice and a losing attempt's events are never delivered.
+    """
+
+    def __init__(self, on_event: EventCallback) -> None:
+        self._on_event = on_event
+        self._lock = threading.Lock()
+        self._owner: str | None = None
+        self._buffers: dict[str, list[dict[str, Any]]] = {}
+
+    @property
+    def owner(self) -> str | None:
+        return self._owner
+
+    def callback(self, label: str) -> Callable[[dict[str, Any]], None]:
+        def emit(event: dict[str, Any]) -> None:
+            with self._lock:
+                if self._owner is None and event.get("kind") == "tool.call":
+                    self._commit(label)
+                if self._owner is None:
+                    self._buffers.setdefault(label, []).append(event)
+                elif self._owner != label:
+                    raise _HedgeLost(label)
+                elif self._on_event is not None:
+                    self._on_event(event)
+
+        return emit
+
+    def _commit(self, label: str) -> None:
+        self._owner = label
+        buffered = self._buffers.pop(label, ())
+        self._buffers.clear()
+        if self._on_event is not None:
+            for event in buffered:
+                self._on_event(event)
+
+    def commit(self, label: str) -> bool:
+        """Claim the run for `label`; False if another attempt already owns it."""
+        with self._lock:
+            if self._owner is None:
+                self._commit(label)
+            return self._owner == label
+
+    def failed(self, label: str) -> None:
+        with self._lock:
+            self._buffers.pop(label, None)
+
+
+def _run_hedged(
+    attempts: list[tuple[str, Callable[..., dict]]],
+    *,
+    on_event: EventCallback = None,
+    delay: float = HEDGE_DELAY_SECONDS,
+) -> dict:
+    """Start the primary provider, hedge with the next one after `delay`, return the first success.
+
+    Hedging only covers the window before the first tool call: the attempt
+    that reaches a tool call first owns the run, and its result or error is final.
+    """
+    relay = _HedgedEventRelay(on_event)
+    pool = ThreadPoolExecutor(max_workers=len(attempts), thread_name_prefix="iris-hedge")
+    pending: dict[Any, str] = {}
+    errors: list[str] = []
+    next_index = 0
+
+    def launch() -> None:
+        nonlocal next_index
+        label, fn = attempts[next_index]
+        next_index += 1
+        pending[pool.submit(fn, on_event=relay.callback(label))] = label
+
+    try:
+        launch()
+        while pending:
+            can_hedge = next_index < len(attempts) and relay.owner is None
+            done, _ = wait(pending, timeout=delay if can_hedge else None, return_when=FIRST_COMPLETED)
+            if not done:
+                launch()
+                continue
+            for future in done:
+                label = pending.pop(future)
+                try:
+                    result = future.result()
+                except _HedgeLost:
+                    continue
+                except Exception as exc:
+                    relay.failed(label)
+                    errors.append(f"{label} failed: {exc}")
+                    if relay.owner == label:
+                        raise RuntimeError("; ".join(errors)) from exc
+                    continue
+                if relay.commit(label):
+                    return result
+            if not pending and next_index < len(attempts) and relay.owner is None:
+                launch()
+        raise RuntimeError("; ".join(errors))
+    finally:
+        # The losing attempt cannot be interrupted mid-request; let it finish in the background.
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _build_screenshot_label(names: list[str]) -> str:
     """Build a short note listing which screenshots are attached."""
-    names = sorted(screenshots.keys())
     return f"[Screenshots attached: {', '.join(names)}. These show the current state of the user's screens.]"
 
 
+def _screenshot_attachments(screenshots: dict[str, bytes] | None) -> ScreenshotAttachments | None:
+    """Sort screenshot names and build their label once per request."""
+    if not screenshots:
+        return None
+    names = sorted(screenshots)
+    return names, _build_screenshot_label(names)
+
+
+VISION_CACHE_MAX_ENTRIES = 32
+VISION_CACHE_MAX_CHARS = 16 * 1024 * 1024
+_vision_cache: OrderedDict[tuple[bytes, int], str] = OrderedDict()
+_vision_cache_chars = 0
+_vision_cache_lock = threading.Lock()
+
+
+def _prepare_vision_image(raw: bytes, max_edge: int = VISION_MAX_EDGE) -> tuple[str, str]:
+    """Downscale a screenshot and re-encode it as WebP; return (media_type, base64).
+
+    Encoded WebP results are memoized by content digest, so the same image
+    attached again skips the re-encode without the cache holding its raw bytes.
+    """
+    global _vision_cache_chars
+    if Image is not None:
+        key = (hashlib.blake2b(raw, digest_size=16).digest(), max_edge)
+        with _vision_cache_lock:
+            hit = _vision_cache.get(key)
+            if hit is not None:
+                _vision_cache.move_to_end(key)
+                return "image/webp", hit
+        try:
+            with Image.open(io.BytesIO(raw)) as img:
+                img.thumbnail((max_edge, max_edge))
+                if img.mode not in ("RGB", "RGBA"):
+                    img = img.convert("RGB")
+                out = io.BytesIO()
+                img.save(out, format="WEBP", quality=VISION_WEBP_QUALITY)
+        except Exception:
+            pass
+        else:
+            encoded = base64.b64encode(out.getvalue()).decode("ascii")
+            if len(encoded) <= VISION_CACHE_MAX_CHARS:
+                with _vision_cache_lock:
+                    previous = _vision_cache.pop(key, None)
+                    _vision_cache_chars -= len(previous or "")
+                    _vision_cache[key] = encoded
+                    _vision_cache_chars += len(encoded)
+                    while len(_vision_cache) > VISION_CACHE_MAX_ENTRIES or _vision_cache_chars > VISION_CACHE_MAX_CHARS:
+                        _vision_cache_chars -= len(_vision_cache.popitem(last=False)[1])
+            return "image/webp", encoded
+    return _guess_image_media_type(raw), base64.b64encode(raw).decode("ascii")
+
+
 def _build_user_content_openai(
-    user_message: str, screenshots: dict[str, bytes] | None
+    user_message: str,
+    screenshots: dict[str, bytes] | None,
+    attachments: ScreenshotAttachments | None = None,
 ) -> str | list[dict[str, Any]]:
     """Build the user message content for OpenAI, with optional inline images."""
     if not screenshots:
         return user_message
+    names, label = attachments or _screenshot_attachments(screenshots)
     parts: list[dict[str, Any]] = []
-    parts.append({"type": "text", "text": f"{user_message}\n\n{_build_screenshot_label(screenshots)}"})
-    for name in sorted(screenshots.keys()):
-        b64 = base64.b64encode(screenshots[name]).decode("ascii")
+    parts.append({"type": "text", "text": f"{user_message}\n\n{label}"})
+    for name in names:
+        media_type, b64 = _prepare_vision_image(screenshots[name], VISION_LOW_DETAIL_MAX_EDGE)
         parts.append({
             "type": "image_url",
-            "image_url": {"url": f"data:image/jpeg;base64,{b64}", "detail": "low"},
+            "image_url": {"url": f"data:{media_type};base64,{b64}", "detail": "low"},
         })
     return parts
 
 
 def _build_user_content_anthropic(
-    user_message: str, screenshots: dict[str, bytes] | None
+    user_message: str,
+    screenshots: dict[str, bytes] | None,
+    attachments: ScreenshotAttachments | None = None,
 ) -> str | list[dict[str, Any]]:
     """Build the user message content for Anthropic, with optional inline images."""
     if not screenshots:
         return user_message
+    names, label = attachments or _screenshot_attachments(screenshots)
     blocks: list[dict[str, Any]] = []
-    blocks.append({"type": "text", "text": f"{user_message}\n\n{_build_screenshot_label(screenshots)}"})
-    for name in sorted(screenshots.keys()):
-        b64 = base64.b64encode(screenshots[name]).decode("ascii")
+    blocks.append({"type": "text", "text": f"{user_message}\n\n{label}"})
+    for name in names:
+        media_type, b64 = _prepare_vision_image(screenshots[name])
         blocks.append({
             "type": "image",
-            "source": {"type": "base64", "media_type": "image/jpeg", "data": b64},
+            "source": {"type": "base64", "media_type": media_type, "data": b64},
         })
     return blocks
 
 
 def _build_user_parts_gemini(
-    user_message: str, screenshots: dict[str, bytes] | None
+    user_message: str,
+    screenshots: dict[str, bytes] | None,
+    attachments: ScreenshotAttachments | None = None,
 ) -> list[dict[str, Any]]:
     """Build the user parts list for Gemini, with optional inline images."""
     if not screenshots:
         return [{"text": user_message}]
+    names, label = attachments or _screenshot_attachments(screenshots)
     parts: list[dict[str, Any]] = []
-    parts.append({"text": f"{user_message}\n\n{_build_screenshot_label(screenshots)}"})
-    for name in sorted(screenshots.keys()):
-        b64 = base64.b64encode(screenshots[name]).decode("ascii")
-        parts.append({"inline_data": {"mime_type": "image/jpeg", "data": b64}})
+    parts.append({"text": f"{user_message}\n\n{label}"})
+    for name in names:
+        media_type, b64 = _prepare_vision_image(screenshots[name])
+        parts.append({"inline_data": {"mime_type": media_type, "data": b64}})
     return parts
 
 
-def _run_openai(messages: list[dict], user_message: str, *, model: str, screenshots: dict[str, bytes] | None = None, on_event: EventCallback = None) -> dict:
-    try:
-        from openai import OpenAI
-    except Exception as exc:
-        raise RuntimeError("openai package is not installed") from exc
-
-    api_key = os.environ.get("OPENAI_API_KEY", "").strip()
+def _run_openai(messages: list[dict], user_message: str, *, model: str, screenshots: dict[str, bytes] | None = None, attachments: ScreenshotAttachments | None = None, on_event: EventCallback = None) -> dict:
+    api_key = _provider_env().openai_api_key
     if not api_key:
         raise RuntimeError("OPENAI_API_KEY is not set")
 
-    client = OpenAI(api_key=api_key)
-    user_content = _build_user_content_openai(user_message, screenshots)
+    client = _openai_client(api_key)
+    user_content = _build_user_content_openai(user_message, screenshots, attachments)
     msgs = (
         [{"role": "system", "content": _build_system_prompt()}]
         + messages
@@ -652,147 +1157,196 @@ def _run_openai(messages: list[dict], user_message: str, *, model: str, screensh
     )
     widgets: list[dict] = []
     tool_calls: list[dict] = []
+    dedupe = _ToolResultDeduper()
 
     for _ in range(MAX_TOOL_ROUNDS):
-        resp = client.chat.completions.create(model=model, messages=msgs, tools=TOOLS)
-        choice = resp.choices[0]
-
-        if choice.finish_reason == "tool_calls" and choice.message.tool_calls:
-            # Emit reasoning text if the LLM said something before tools
-            reasoning = (choice.message.content or "").strip()
-            if reasoning and on_event:
-                on_event({"kind": "reasoning", "text": reasoning})
-
-            msgs.append(choice.message.model_dump())
-            for tc in choice.message.tool_calls:
-                args = json.loads(tc.function.arguments)
-                tool_call = _tool_call_info(tc.function.name, args)
-                tool_calls.append(tool_call)
-                if on_event:
-                    on_event({"kind": "tool.call", "name": tc.function.name, "input": tool_call})
-                if tc.function.name == "push_widget":
-                    widget = _normalize_widget_args(args)
-                    widgets.append(widget)
-                    _attach_tool_call_result(tool_call, {
-                        "ok": True,
-                        "widget_id": widget["widget_id"],
-                        "target": widget["target"],
-                        "width": widget["width"],
-                        "height": widget["height"],
-                    })
-                    if on_event:
-                        on_event({"kind": "tool.result", "name": tc.function.name, "ok": True, "summary": f"Widget '{widget['widget_id']}' → {widget['target']}"})
-                    msgs.append({
-                        "role": "tool",
-                        "tool_call_id": tc.id,
-                        "content": (
-                            f"Widget '{widget['widget_id']}' created "
-                            f"({widget['width']}x{widget['height']}) at "
-                            f"{widget['coordinate_space']} "
-                            f"({widget['x']}, {widget['y']}) anchor={widget['anchor']}."
-                        ),
-                    })
-                    continue
+        speculative: dict[int, Future[_ToolOutcome]] = {}
+
+        def start_tool(index: int, call: dict[str, Any]) -> None:
+            # Runs as soon as a call's arguments are complete, while the model
+            # may still be streaming later calls. Only read-only tools start
+            # here: the turn may still end without finish_reason "tool_calls".
+            if call["name"] in _SPECULATIVE_TOOLS:
+                args = _decode_openai_tool_args(call)
+                if args is not None:
+                    speculative[index] = _submit_tool(
+                        call["name"], args, screenshots=screenshots, user_message=user_message
+                    )
 
-                if tc.function.name == "read_screenshot":
-                    analysis = _handle_read_screenshot(args)
-                    _attach_tool_call_result(tool_call, analysis)
-                    if on_event:
-                        on_event({"kind": "tool.result", "name": tc.function.name, "ok": True, "summary": "Screenshot analyzed"})
-                    msgs.append({
-                        "role": "tool",
-                        "tool_call_id": tc.id,
-                        "content": analysis,
-                    })
-                    continue
+        content, streamed_calls, finish_reason = _stream_openai_turn(
+            client, model=model, msgs=msgs, on_call=start_tool
+        )
 
-                if tc.function.name == "read_widget":
-                    result = _handle_read_widget(args)
-                    _attach_tool_call_result(tool_call, result)
-                    if on_event:
-                        on_event({"kind": "tool.result", "name": tc.function.name, "ok": True, "summary": "Widget loaded"})
-                    msgs.append({
-                        "role": "tool",
-                        "tool_call_id": tc.id,
-                        "content": result,
-                    })
-                    continue
+        if finish_reason != "tool_calls" or not streamed_calls:
+            return {"text": content, "widgets": widgets, "tool_calls": tool_calls}
+
+        # Emit reasoning text if the LLM said something before tools
+        reasoning = content.strip()
+        if reasoning and on_event:
+            on_event({"kind": "reasoning", "text": reasoning})
+
+        msgs.append({
+            "role": "assistant",
+            "content": content or None,
+            "tool_calls": [
+                {
+                    "id": call["id"],
+                    "type": "function",
+                    "function": {"name": call["name"], "arguments": call["arguments"]},
+                }
+                for call in streamed_calls
+            ],
+        })
+        pending: list[tuple[dict[str, Any], dict[str, Any], Future[_ToolOutcome]]] = []
+        for index, call in enumerate(streamed_calls):
+            name = call["name"]
+            args = _decode_openai_tool_args(call)
+            tool_call = _tool_call_info(name, args or {})
+            tool_calls.append(tool_call)
+            if on_event:
+                on_event({"kind": "tool.call", "name": name, "input": tool_call})
+            if args is None:
+                future: Future[_ToolOutcome] = Future()
+                future.set_result(_invalid_tool_args_outcome(name))
+            else:
+                future = speculative.pop(index, None) or _submit_tool(
+                    name, args, screenshots=screenshots, user_message=user_message
+                )
+            pending.append((call, tool_call, future))
+        for call, tool_call, future in pending:
+            outcome = future.result()
+            if outcome.widget is not None:
+                widgets.append(outcome.widget)
+            _attach_tool_call_result(tool_call, outcome.result)
+            if on_event:
+                on_event({"kind": "tool.result", "name": call["name"], "ok": outcome.ok, "summary": outcome.summary})
+            msgs.append({
+                "role": "tool",
+                "tool_call_id": call["id"],
+                "content": dedupe.content(call["id"], outcome.content),
+            })
 
-                if tc.function.name == "run_browser_task":
-                    result = _handle_run_browser_task(
-                        args,
-                        screenshots=screenshots,
-                        user_message=user_message,
-                    )
-                    _attach_tool_call_result(tool_call, result)
-                    if on_event:
-                        on_event({"kind": "tool.result", "name": tc.function.name, "ok": True, "summary": "Browser task completed"})
-                    msgs.append({
-                        "role": "tool",
-                        "tool_call_id": tc.id,
-                        "content": result,
-                    })
-                    continue
+    return {"text": "Tool loop exhausted. Please try again.", "widgets": widgets, "tool_calls": tool_calls}
 
-                _attach_tool_call_result(tool_call, {
-                    "ok": False,
-                    "error": f"Unsupported tool '{tc.function.name}'.",
-                })
-                if on_event:
-                    on_event({"kind": "tool.result", "name": tc.function.name, "ok": False, "summary": f"Unsupported tool"})
-                msgs.append({
-                    "role": "tool",
-                    "tool_call_id": tc.id,
-                    "content": f"Unsupported tool '{tc.function.name}'.",
-                })
-        else:
-            return {"text": choice.message.content or "", "widgets": widgets, "tool_calls": tool_calls}
 
-    return {"text": "Tool loop exhausted. Please try again.", "widgets": widgets, "tool_calls": tool_calls}
+def _stream_openai_turn(
+    client: OpenAI,
+    *,
+    model: str,
+    msgs: list[dict[str, Any]],
+    on_call: Callable[[int, dict[str, Any]], None],
+) -> tuple[str, list[dict[str, str]], str | None]:
+    """Stream one chat completion, handing each tool call to `on_call` once its arguments close.
+
+    Tool-call deltas arrive in index order, so a call is complete as soon as
+    the next index starts (or the stream ends). Returns the text, the calls
+    and the choice's finish_reason.
+    """
+    stream = client.chat.completions.create(model=model, messages=msgs, tools=TOOLS, stream=True)
+    text_parts: list[str] = []
+    calls: list[dict[str, Any]] = []
+    by_index: dict[int, dict[str, Any]] = {}
+    finish_reason: str | None = None
+
+    closed = 0
+
+    def close_open_calls() -> None:
+        nonlocal closed
+        while closed < len(calls):
+            call = calls[closed]
+            call["arguments"] = "".join(call["arguments"])
+            on_call(closed, call)
+            closed += 1
+
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        choice = chunk.choices[0]
+        finish_reason = choice.finish_reason or finish_reason
+        delta = choice.delta
+        if delta is None:
+            continue
+        if delta.content:
+            text_parts.append(delta.content)
+        for tc in delta.tool_calls or ():
+            call = by_index.get(tc.index)
+            if call is None:
+                close_open_calls()
+                call = {"id": "", "name": "", "arguments": []}
+                by_index[tc.index] = call
+                calls.append(call)
+            if tc.id:
+                call["id"] = tc.id
+            fn = tc.function
+            if fn is not None:
+                if fn.name:
+                    call["name"] += fn.name
+                if fn.arguments:
+                    call["arguments"].append(fn.arguments)
+    close_open_calls()
+
+    return "".join(text_parts), calls, finish_reason
+
+
+def _decode_openai_tool_args(call: dict[str, Any]) -> dict[str, Any] | None:
+    """Parse a streamed call's arguments; None when they are not a JSON object."""
+    try:
+        args = _json_loads(call["arguments"] or "{}")
+    except json.JSONDecodeError:
+        return None
+    return args if isinstance(args, dict) else None
 
 
-def _run_anthropic(messages: list[dict], user_message: str, *, model: str | None = None, screenshots: dict[str, bytes] | None = None, on_event: EventCallback = None) -> dict:
-    api_key = os.environ.get("ANTHROPIC_API_KEY", "").strip()
+def _invalid_tool_args_outcome(name: str) -> _ToolOutcome:
+    return _ToolOutcome(
+        ok=False,
+        summary="Invalid arguments",
+        result={"ok": False, "error": f"Arguments for '{name}' were not a valid JSON object."},
+        content=f"Arguments for '{name}' were not a valid JSON object. Retry the call with valid JSON.",
+    )
+
+
+def _run_anthropic(messages: list[dict], user_message: str, *, model: str | None = None, screenshots: dict[str, bytes] | None = None, attachments: ScreenshotAttachments | None = None, on_event: EventCallback = None) -> dict:
+    provider_env = _provider_env()
+    api_key = provider_env.anthropic_api_key
     if not api_key:
         raise RuntimeError("ANTHROPIC_API_KEY is not set")
 
-    model = (
-        (model or "").strip()
-        or os.environ.get("ANTHROPIC_MODEL", DEFAULT_ANTHROPIC_MODEL).strip()
-        or DEFAULT_ANTHROPIC_MODEL
-    )
+    model = (model or "").strip() or provider_env.anthropic_model
     widgets: list[dict] = []
     tool_calls: list[dict] = []
-    user_content = _build_user_content_anthropic(user_message, screenshots)
+    dedupe = _ToolResultDeduper()
+    user_content = _build_user_content_anthropic(user_message, screenshots, attachments)
     anth_messages = _to_anthropic_messages(messages + [{"role": "user", "content": user_content}])
+    static_members = _anthropic_static_members(_build_system_prompt())
+    history = _EncodedHistory(anth_messages)
 
     for _ in range(MAX_TOOL_ROUNDS):
-        body = {
-            "model": model,
-            "max_tokens": ANTHROPIC_MAX_TOKENS,
-            "system": _build_system_prompt(),
-            "messages": anth_messages,
-            "tools": _anthropic_tools(),
-        }
-        data = _anthropic_post("/v1/messages", body, api_key)
+        body = {"model": model, "max_tokens": ANTHROPIC_MAX_TOKENS}
+        members = static_members + b"," + history.member("messages", last=_with_anthropic_cache_breakpoint)
+        speculative: dict[str, Future[_ToolOutcome]] = {}
+
+        def on_tool_use(block: dict[str, Any]) -> None:
+            if block.get("name") in _SPECULATIVE_TOOLS:
+                speculative[block.get("id")] = _submit_tool(
+                    block["name"], block.get("input") or {}, screenshots=screenshots, user_message=user_message
+                )
+
+        data = _anthropic_stream(body, api_key, on_tool_use=on_tool_use, preencoded=members)
 
         content_blocks = data.get("content", [])
         stop_reason = data.get("stop_reason")
+        invalid_tool_use_ids = data.get("invalid_tool_use_ids") or set()
 
         if stop_reason == "tool_use":
             # Emit reasoning from text blocks before tool_use blocks
             if on_event:
-                reasoning_parts = [
-                    block.get("text", "")
-                    for block in content_blocks
-                    if isinstance(block, dict) and block.get("type") == "text"
-                ]
-                reasoning = "".join(reasoning_parts).strip()
+                reasoning = _anthropic_text(content_blocks).strip()
                 if reasoning:
                     on_event({"kind": "reasoning", "text": reasoning})
 
             anth_messages.append({"role": "assistant", "content": content_blocks})
-            tool_results = []
+            pending: list[tuple[dict[str, Any], dict[str, Any], Future[_ToolOutcome]]] = []
             for block in content_blocks:
                 if block.get("type") != "tool_use":
                     continue
@@ -802,116 +1356,65 @@ def _run_anthropic(messages: list[dict], user_message: str, *, model: str | None
                 tool_calls.append(tool_call)
                 if on_event:
                     on_event({"kind": "tool.call", "name": tool_name, "input": tool_call})
-                if tool_name == "push_widget":
-                    widget = _normalize_widget_args(args)
-                    widgets.append(widget)
-                    _attach_tool_call_result(tool_call, {
-                        "ok": True,
-                        "widget_id": widget["widget_id"],
-                        "target": widget["target"],
-                        "width": widget["width"],
-                        "height": widget["height"],
-                    })
-                    if on_event:
-                        on_event({"kind": "tool.result", "name": tool_name, "ok": True, "summary": f"Widget '{widget['widget_id']}' → {widget['target']}"})
-                    tool_results.append({
-                        "type": "tool_result",
-                        "tool_use_id": block.get("id"),
-                        "content": (
-                            f"Widget '{widget['widget_id']}' created "
-                            f"({widget['width']}x{widget['height']}) at "
-                            f"{widget['coordinate_space']} "
-                            f"({widget['x']}, {widget['y']}) anchor={widget['anchor']}."
-                        ),
-                    })
-                    continue
-
-                if tool_name == "read_screenshot":
-                    analysis = _handle_read_screenshot(args)
-                    _attach_tool_call_result(tool_call, analysis)
-                    if on_event:
-                        on_event({"kind": "tool.result", "name": tool_name, "ok": True, "summary": "Screenshot analyzed"})
-                    tool_results.append({
-                        "type": "tool_result",
-                        "tool_use_id": block.get("id"),
-                        "content": analysis,
-                    })
-                    continue
-
-                if tool_name == "read_widget":
-                    result = _handle_read_widget(args)
-                    _attach_tool_call_result(tool_call, result)
-                    if on_event:
-                        on_event({"kind": "tool.result", "name": tool_name, "ok": True, "summary": "Widget loaded"})
-                    tool_results.append({
-                        "type": "tool_result",
-                        "tool_use_id": block.get("id"),
-                        "content": result,
-                    })
-                    continue
-
-                if tool_name == "run_browser_task":
-                    result = _handle_run_browser_task(
-                        args,
-                        screenshots=screenshots,
-                        user_message=user_message,
+                if str(block.get("id")) in invalid_tool_use_ids:
+                    future: Future[_ToolOutcome] = Future()
+                    future.set_result(_invalid_tool_args_outcome(tool_name))
+                else:
+                    future = speculative.pop(block.get("id"), None) or _submit_tool(
+                        tool_name, args, screenshots=screenshots, user_message=user_message
                     )
-                    _attach_tool_call_result(tool_call, result)
-                    if on_event:
-                        on_event({"kind": "tool.result", "name": tool_name, "ok": True, "summary": "Browser task completed"})
-                    tool_results.append({
-                        "type": "tool_result",
-                        "tool_use_id": block.get("id"),
-                        "content": result,
-                    })
-                    continue
+                pending.append((block, tool_call, future))
 
-                _attach_tool_call_result(tool_call, {
-                    "ok": False,
-                    "error": f"Unsupported tool '{tool_name}'.",
-                })
+            tool_results = []
+            for block, tool_call, future in pending:
+                outcome = future.result()
+                if outcome.widget is not None:
+                    widgets.append(outcome.widget)
+                _attach_tool_call_result(tool_call, outcome.result)
                 if on_event:
-                    on_event({"kind": "tool.result", "name": tool_name, "ok": False, "summary": "Unsupported tool"})
+                    on_event({"kind": "tool.result", "name": block.get("name"), "ok": outcome.ok, "summary": outcome.summary})
                 tool_results.append({
                     "type": "tool_result",
                     "tool_use_id": block.get("id"),
-                    "content": f"Unsupported tool '{tool_name}'.",
+                    "content": dedupe.content(str(block.get("id")), outcome.content),
                 })
             anth_messages.append({"role": "user", "content": tool_results})
             continue
 
-        text = "".join(
-            block.get("text", "")
-            for block in content_blocks
-            if isinstance(block, dict) and block.get("type") == "text"
-        )
+        text = _anthropic_text(content_blocks)
         return {"text": text, "widgets": widgets, "tool_calls": tool_calls}
 
     return {"text": "Tool loop exhausted. Please try again.", "widgets": widgets, "tool_calls": tool_calls}
 
 
-def _run_gemini(messages: list[dict], user_message: str, *, model: str, screenshots: dict[str, bytes] | None = None, on_event: EventCallback = None) -> dict:
-    api_key = (
-        os.environ.get("GEMINI_API_KEY", "").strip()
-        or os.environ.get("GOOGLE_API_KEY", "").strip()
-    )
+def _run_gemini(messages: list[dict], user_message: str, *, model: str, screenshots: dict[str, bytes] | None = None, attachments: ScreenshotAttachments | None = None, on_event: EventCallback = None) -> dict:
+    api_key = _provider_env().gemini_api_key
     if not api_key:
         raise RuntimeError("GEMINI_API_KEY or GOOGLE_API_KEY is not set")
 
     # Build contents: history + final user message with screenshots
-    user_parts = _build_user_parts_gemini(user_message, screenshots)
+    user_parts = _build_user_parts_gemini(user_message, screenshots, attachments)
     contents = _to_gemini_contents(messages) + [{"role": "user", "parts": user_parts}]
     widgets: list[dict[str, Any]] = []
     tool_calls: list[dict] = []
+    dedupe = _ToolResultDeduper()
     no_candidate_count = 0
+    static_members = _gemini_static_members(_build_system_prompt())
+    history = _EncodedHistory(contents)
 
     for _ in range(MAX_TOOL_ROUNDS):
-        body = {
-            "system_instruction": {"parts": [{"text": _build_system_prompt()}]},
-            "contents": contents,
-            "tools": [{"function_declarations": _gemini_function_declarations()}],
-        }
-        data = _gemini_post(model, body, api_key)
+        members = static_members + b"," + history.member("contents")
+        speculative: list[Future[_ToolOutcome] | None] = []
+
+        def on_function_call(call: dict[str, Any]) -> None:
+            name = str(call.get("name") or "").strip()
+            args = call.get("args")
+            if name in _SPECULATIVE_TOOLS and isinstance(args, dict):
+                speculative.append(_submit_tool(name, args, screenshots=screenshots, user_message=user_message))
+            else:
+                speculative.append(None)
+
+        data = _gemini_stream(model, {}, api_key, on_function_call=on_function_call, preencoded=members)
         candidates = data.get("candidates")
         if not isinstance(candidates, list) or not candidates:
             no_candidate_count += 1
@@ -943,17 +1446,13 @@ def _run_gemini(messages: list[dict], user_message: str, *, model: str, screensh
         if function_calls:
             # Emit reasoning from text parts before function calls
             if on_event:
-                reasoning_text = "".join(
-                    part.get("text", "")
-                    for part in parts
-                    if isinstance(part, dict) and isinstance(part.get("text"), str)
-                ).strip()
+                reasoning_text = _gemini_text(parts).strip()
                 if reasoning_text:
                     on_event({"kind": "reasoning", "text": reasoning_text})
 
             contents.append({"role": "model", "parts": [{"functionCall": fc} for fc in function_calls]})
-            tool_response_parts: list[dict[str, Any]] = []
-            for call in function_calls:
+            pending: list[tuple[str, dict[str, Any], Future[_ToolOutcome]]] = []
+            for index, call in enumerate(function_calls):
                 name = str(call.get("name") or "").strip()
                 args = call.get("args")
                 if not isinstance(args, dict):
@@ -962,110 +1461,88 @@ def _run_gemini(messages: list[dict], user_message: str, *, model: str, screensh
                 tool_calls.append(tool_call)
                 if on_event:
                     on_event({"kind": "tool.call", "name": name, "input": tool_call})
+                future = (speculative[index] if index < len(speculative) else None) or _submit_tool(
+                    name, args, screenshots=screenshots, user_message=user_message
+                )
+                pending.append((name, tool_call, future))
 
-                if name == "push_widget":
-                    widget = _normalize_widget_args(args)
-                    widgets.append(widget)
-                    _attach_tool_call_result(tool_call, {
-                        "ok": True,
-                        "widget_id": widget["widget_id"],
-                        "target": widget["target"],
-                        "width": widget["width"],
-                        "height": widget["height"],
-                    })
-                    if on_event:
-                        on_event({"kind": "tool.result", "name": name, "ok": True, "summary": f"Widget '{widget['widget_id']}' → {widget['target']}"})
-                    tool_response_parts.append({
-                        "functionResponse": {
-                            "name": name,
-                            "response": {
-                                "ok": True,
-                                "widget_id": widget["widget_id"],
-                                "detail": (
-                                    f"Widget placed at {widget['coordinate_space']} "
-                                    f"({widget['x']}, {widget['y']})"
-                                ),
-                            },
-                        }
-                    })
-                    continue
-
-                if name == "read_screenshot":
-                    analysis = _handle_read_screenshot(args)
-                    _attach_tool_call_result(tool_call, analysis)
-                    if on_event:
-                        on_event({"kind": "tool.result", "name": name, "ok": True, "summary": "Screenshot analyzed"})
-                    tool_response_parts.append({
-                        "functionResponse": {
-                            "name": name,
-                            "response": {"ok": True, "analysis": analysis},
-                        }
-                    })
-                    continue
-
-                if name == "read_widget":
-                    result = _handle_read_widget(args)
-                    _attach_tool_call_result(tool_call, result)
-                    if on_event:
-                        on_event({"kind": "tool.result", "name": name, "ok": True, "summary": "Widget loaded"})
-                    tool_response_parts.append({
-                        "functionResponse": {
-                            "name": name,
-                            "response": {"ok": True, "widget": result},
-                        }
-                    })
-                    continue
-
-                if name == "run_browser_task":
-                    result = _handle_run_browser_task(
-                        args,
-                        screenshots=screenshots,
-                        user_message=user_message,
-                    )
-                    response: dict[str, Any]
-                    try:
-                        parsed = json.loads(result)
-                        if isinstance(parsed, dict):
-                            response = parsed
-                        else:
-                            response = {"ok": True, "result": result}
-                    except json.JSONDecodeError:
-                        response = {"ok": True, "result": result}
-                    _attach_tool_call_result(tool_call, response)
-                    if on_event:
-                        on_event({"kind": "tool.result", "name": name, "ok": True, "summary": "Browser task completed"})
-                    tool_response_parts.append({
-                        "functionResponse": {
-                            "name": name,
-                            "response": response,
-                        }
-                    })
-                    continue
-
-                unsupported = {"ok": False, "error": f"Unsupported tool '{name}'"}
-                _attach_tool_call_result(tool_call, unsupported)
+            tool_response_parts: list[dict[str, Any]] = []
+            for position, (name, tool_call, future) in enumerate(pending):
+                outcome = future.result()
+                if outcome.widget is not None:
+                    widgets.append(outcome.widget)
+                response = _gemini_function_response(name, outcome)
+                _attach_tool_call_result(tool_call, response if name == "run_browser_task" else outcome.result)
+                # Gemini calls carry no ids; number them across the whole loop.
+                deduped = dedupe.content(f"#{len(tool_calls) - len(pending) + position + 1} ({name})", outcome.content)
+                if deduped is not outcome.content:
+                    response = {"ok": outcome.ok, "note": deduped}
                 if on_event:
-                    on_event({"kind": "tool.result", "name": name, "ok": False, "summary": "Unsupported tool"})
+                    on_event({"kind": "tool.result", "name": name, "ok": outcome.ok, "summary": outcome.summary})
                 tool_response_parts.append({
                     "functionResponse": {
                         "name": name or "unknown",
-                        "response": unsupported,
+                        "response": response,
                     }
                 })
 
             contents.append({"role": "user", "parts": tool_response_parts})
             continue
 
-        text = "".join(
-            part.get("text", "")
-            for part in parts
-            if isinstance(part, dict) and isinstance(part.get("text"), str)
-        )
+        text = _gemini_text(parts)
         return {"text": text, "widgets": widgets, "tool_calls": tool_calls}
 
     return {"text": "Tool loop exhausted. Please try again.", "widgets": widgets, "tool_calls": tool_calls}
 
 
+def _anthropic_text(blocks: list[Any]) -> str:
+    """Concatenate the text blocks of an Anthropic content list.
+
+    A list (not a generator) lets str.join size the result in one go.
+    """
+    return "".join([
+        block["text"]
+        for block in blocks
+        if type(block) is dict and block.get("type") == "text" and "text" in block
+    ])
+
+
+def _gemini_text(parts: list[Any]) -> str:
+    """Concatenate the text of Gemini content parts in one pass."""
+    return "".join([
+        text
+        for part in parts
+        if type(part) is dict and type(text := part.get("text")) is str
+    ])
+
+
+def _gemini_function_response(name: str, outcome: _ToolOutcome) -> dict[str, Any]:
+    """Shape a tool outcome as a Gemini functionResponse payload."""
+    if outcome.widget is not None:
+        widget = outcome.widget
+        return {
+            "ok": True,
+            "widget_id": widget["widget_id"],
+            "detail": (
+                f"Widget placed at {widget['coordinate_space']} "
+                f"({widget['x']}, {widget['y']})"
+            ),
+        }
+    if not outcome.ok:
+        return outcome.result
+    if name == "read_screenshot":
+        return {"ok": True, "analysis": outcome.result}
+    if name == "read_widget":
+        return {"ok": True, "widget": outcome.result}
+    if isinstance(outcome.result, dict):
+        return outcome.result
+    try:
+        parsed = _json_loads(outcome.result)
+    except json.JSONDecodeError:
+        parsed = None
+    return parsed if isinstance(parsed, dict) else {"ok": True, "result": outcome.result}
+
+
 def _to_anthropic_messages(messages: list[dict]) -> list[dict]:
     out: list[dict] = []
     for msg in messages:
@@ -1093,9 +1570,68 @@ def _anthropic_tools() -> list[dict]:
                 "input_schema": fn["parameters"],
             }
         )
+    # Cache breakpoint after the last tool covers the whole tool list.
+    out[-1]["cache_control"] = _ANTHROPIC_EPHEMERAL
     return out
 
 
+# Prompt-cache breakpoints: system prompt, tool list, and the tail of the
+# conversation (moved forward every round), within Anthropic's limit of 4.
+_ANTHROPIC_EPHEMERAL = {"type": "ephemeral"}
+
+# TOOLS is static; built once at import and shared read-only by every request.
+_ANTHROPIC_TOOLS = _anthropic_tools()
+
+
+@lru_cache(maxsize=4)
+def _anthropic_static_members(system_prompt: str) -> bytes:
+    """System + tools members of a /v1/messages body, encoded once per prompt."""
+    return _json_dumpb({
+        "system": [{"type": "text", "text": system_prompt, "cache_control": _ANTHROPIC_EPHEMERAL}],
+        "tools": _ANTHROPIC_TOOLS,
+    })[1:-1]
+
+
+def _with_anthropic_cache_breakpoint(message: dict) -> dict:
+    """Return `message` with a cache breakpoint on its final content block.
+
+    The message itself is left untouched so earlier rounds' breakpoints do
+    not accumulate in the history.
+    """
+    content = message.get("content")
+    if isinstance(content, str) and content:
+        blocks = [{"type": "text", "text": content}]
+    elif isinstance(content, list) and content and isinstance(content[-1], dict):
+        blocks = list(content)
+    else:
+        return message
+    blocks[-1] = {**blocks[-1], "cache_control": _ANTHROPIC_EPHEMERAL}
+    return {**message, "content": blocks}
+
+
+class _EncodedHistory:
+    """Append-only message list that serializes each message once.
+
+    Tool loops resend the whole conversation (screenshots included) every
+    round; messages encoded in earlier rounds are spliced in as bytes, so
+    each round only encodes what it appended. Messages must not be mutated
+    once appended.
+    """
+
+    def __init__(self, messages: list[dict]) -> None:
+        self.messages = messages
+        self._encoded: list[bytes] = []
+
+    def member(self, name: str, *, last: Callable[[dict], dict] | None = None) -> bytes:
+        """Encode the history as a `"name":[...]` object member; `last` rewrites the final message."""
+        messages, encoded = self.messages, self._encoded
+        encoded.extend(_json_dumpb(message) for message in messages[len(encoded):])
+        parts = encoded
+        if last is not None and messages:
+            parts = [*encoded[:-1], _json_dumpb(last(messages[-1]))]
+        return b'"' + name.encode("utf-8") + b'":[' + b",".join(parts) + b"]"
+
+
 def _gemini_function_declarations() -> list[dict[str, Any]]:
     out: list[dict[str, Any]] = []
     for tool in TOOLS:
@@ -1108,149 +1644,531 @@ def _gemini_function_declarations() -> list[dict[str, Any]]:
     return out
 
 
-def _anthropic_post(path: str, body: dict[str, Any], api_key: str) -> dict[str, Any]:
+# Likewise built once at import and shared read-only.
+_GEMINI_TOOLS = [{"function_declarations": _gemini_function_declarations()}]
+
+
+@lru_cache(maxsize=4)
+def _gemini_static_members(system_prompt: str) -> bytes:
+    """system_instruction + tools members of a generateContent body, encoded once per prompt."""
+    return _json_dumpb({
+        "system_instruction": {"parts": [{"text": system_prompt}]},
+        "tools": _GEMINI_TOOLS,
+    })[1:-1]
+
+
+def _backoff_sleep(base: float, attempt: int) -> None:
+    """Exponential backoff with up to 10% jitter so concurrent retries spread out."""
+    delay = base * (2 ** attempt)
+    time.sleep(delay + random.uniform(0, delay * 0.1))
+
+
+_http_clients: dict[str, httpx.Client] = {}
+_http_clients_lock = threading.Lock()
+
+
+def _http_client(base_url: str, timeout: float) -> httpx.Client:
+    """Return a pooled keep-alive client for one API host, created on first use.
+
+    With h2 installed, concurrent requests (hedged providers, parallel agent
+    runs) multiplex over one HTTP/2 connection instead of opening more.
+    """
+    with _http_clients_lock:
+        client = _http_clients.get(base_url)
+        if client is None:
+            client = httpx.Client(
+                base_url=base_url,
+                http2=_HTTP2,
+                timeout=httpx.Timeout(timeout, connect=10.0),
+                limits=httpx.Limits(max_keepalive_connections=20),
+            )
+            _http_clients[base_url] = client
+        return client
+
+
+@atexit.register
+def _close_http_clients() -> None:
+    """Close pooled connections (OpenAI's included) cleanly at interpreter exit."""
+    with _http_clients_lock:
+        clients = list(_http_clients.values())
+        _http_clients.clear()
+    for client in clients:
+        with contextlib.suppress(Exception):
+            client.close()
+
+
+def _anthropic_open(path: str, body: dict[str, Any], api_key: str, *, preencoded: bytes = b"") -> httpx.Response:
+    """POST to Anthropic with retry/backoff and return the open (unread) response."""
+    client = _http_client("https://api.anthropic.com", ANTHROPIC_HTTP_TIMEOUT_SECONDS)
+    payload = _json_dumpb_with(preencoded, body)
+    headers = {
+        "x-api-key": api_key,
+        "anthropic-version": "2023-06-01",
+        "content-type": "application/json",
+    }
     attempts = ANTHROPIC_HTTP_RETRIES + 1
     last_error: Exception | None = None
     for attempt in range(attempts):
-        req = urllib.request.Request(
-            f"https://api.anthropic.com{path}",
-            data=json.dumps(body).encode("utf-8"),
-            method="POST",
-            headers={
-                "x-api-key": api_key,
-                "anthropic-version": "2023-06-01",
-                "content-type": "application/json",
-            },
-        )
         try:
-            with urllib.request.urlopen(req, timeout=ANTHROPIC_HTTP_TIMEOUT_SECONDS) as resp:
-                return json.loads(resp.read().decode("utf-8"))
-        except urllib.error.HTTPError as exc:
-            detail = exc.read().decode("utf-8", errors="ignore")
-            retryable = exc.code in {408, 429, 500, 502, 503, 504, 529} or _is_transient_anthropic_detail(detail)
-            if retryable and attempt < attempts - 1:
-                time.sleep(ANTHROPIC_HTTP_BACKOFF_SECONDS * (2 ** attempt))
-                continue
-            last_error = RuntimeError(f"Anthropic HTTP {exc.code}: {detail[:300]}")
-            break
-        except urllib.error.URLError as exc:
-            reason = str(getattr(exc, "reason", exc))
+            resp = client.send(client.build_request("POST", path, content=payload, headers=headers), stream=True)
+        except httpx.TransportError as exc:
             if attempt < attempts - 1:
-                time.sleep(ANTHROPIC_HTTP_BACKOFF_SECONDS * (2 ** attempt))
+                _backoff_sleep(ANTHROPIC_HTTP_BACKOFF_SECONDS, attempt)
                 continue
-            last_error = RuntimeError(f"Anthropic request failed: {reason[:300]}")
+            last_error = RuntimeError(f"Anthropic request failed: {str(exc)[:300]}")
             break
+        if resp.status_code < 400:
+            return resp
+        try:
+            detail = resp.read().decode("utf-8", errors="ignore")
+        finally:
+            resp.close()
+        retryable = resp.status_code in {408, 429, 500, 502, 503, 504, 529} or _is_transient_anthropic_detail(detail)
+        if retryable and attempt < attempts - 1:
+            _backoff_sleep(ANTHROPIC_HTTP_BACKOFF_SECONDS, attempt)
+            continue
+        last_error = RuntimeError(f"Anthropic HTTP {resp.status_code}: {detail[:300]}")
+        break
     assert last_error is not None
     raise last_error
 
 
-def _is_transient_anthropic_detail(detail: str) -> bool:
-    lowered = (detail or "").lower()
-    markers = (
-        "timed out",
-        "timeout",
-        "interrupted",
-        "overloaded",
-        "try again",
-        "long requests",
+def _anthropic_post(path: str, body: dict[str, Any], api_key: str) -> dict[str, Any]:
+    with contextlib.closing(_anthropic_open(path, body, api_key)) as resp:
+        return _json_loads(resp.read())
+
+
+def _iter_sse_data(lines: Iterable[str]) -> Iterator[str]:
+    """Yield the data payload of each server-sent event as it arrives."""
+    buffer: list[str] = []
+    for raw in lines:
+        line = raw.rstrip("\r\n")
+        if not line:
+            if buffer:
+                yield "\n".join(buffer)
+                buffer = []
+            continue
+        if line.startswith("data:"):
+            data = line[5:]
+            buffer.append(data[1:] if data.startswith(" ") else data)
+    if buffer:
+        yield "\n".join(buffer)
+
+
+class _TransientStreamError(RuntimeError):
+    """A provider reported a retryable failure partway through a stream."""
+
+
+def _retry_stream(
+    provider: str,
+    retries: int,
+    backoff: float,
+    attempt: Callable[[], dict[str, Any]],
+    committed: Callable[[], bool],
+) -> dict[str, Any]:
+    """Run one streamed call, restarting it on transient failures.
+
+    A restart is only safe while ``committed()`` is False, i.e. before any
+    delta has reached the caller's callbacks; after that the error surfaces.
+    Transport errors are wrapped in the same RuntimeError as a failed open.
+    """
+    attempts = retries + 1
+    for n in range(attempts):
+        try:
+            return attempt()
+        except _TransientStreamError:
+            if committed() or n == attempts - 1:
+                raise
+        except httpx.TransportError as exc:
+            if committed() or n == attempts - 1:
+                raise RuntimeError(f"{provider} request failed: {str(exc)[:300]}") from exc
+        except httpx.HTTPError as exc:
+            raise RuntimeError(f"{provider} request failed: {str(exc)[:300]}") from exc
+        _backoff_sleep(backoff, n)
+    raise AssertionError("unreachable")
+
+
+def _anthropic_stream(
+    body: dict[str, Any],
+    api_key: str,
+    *,
+    on_tool_use: Callable[[dict[str, Any]], None] | None = None,
+    preencoded: bytes = b"",
+) -> dict[str, Any]:
+    """Stream a /v1/messages call, assembling content blocks as they arrive.
+
+    ``on_tool_use`` receives each tool_use block as soon as its input JSON
+    closes. ``preencoded`` holds body members serialized ahead of time.
+    Returns the same ``{"content": [...], "stop_reason": ...}`` shape as the
+    non-streaming endpoint so callers can treat both alike, plus
+    ``invalid_tool_use_ids`` for tool_use blocks whose input JSON did not
+    parse (their ``input`` is left empty and ``on_tool_use`` is not called).
+    """
+    committed = False
+
+    def forward_tool_use(block: dict[str, Any]) -> None:
+        nonlocal committed
+        committed = True
+        on_tool_use(block)
+
+    return _retry_stream(
+        "Anthropic",
+        ANTHROPIC_HTTP_RETRIES,
+        ANTHROPIC_HTTP_BACKOFF_SECONDS,
+        lambda: _anthropic_stream_attempt(
+            body,
+            api_key,
+            on_tool_use=forward_tool_use if on_tool_use else None,
+            preencoded=preencoded,
+        ),
+        lambda: committed,
     )
-    return any(marker in lowered for marker in markers)
+
+
+def _anthropic_stream_attempt(
+    body: dict[str, Any],
+    api_key: str,
+    *,
+    on_tool_use: Callable[[dict[str, Any]], None] | None,
+    preencoded: bytes,
+) -> dict[str, Any]:
+    blocks: dict[int, dict[str, Any]] = {}
+    invalid_tool_use_ids: set[str] = set()
+    pieces: dict[int, list[str]] = {}
+    stop_reason: str | None = None
+
+    def close_block(index: int) -> None:
+        block = blocks.get(index)
+        joined = "".join(pieces.pop(index, ()))
+        if block is None:
+            return
+        if block.get("type") == "text":
+            block["text"] = block.get("text", "") + joined
+        elif block.get("type") == "tool_use":
+            try:
+                tool_input = _json_loads(joined) if joined else (block.get("input") or {})
+            except json.JSONDecodeError:
+                tool_input = None
+            if not isinstance(tool_input, dict):
+                # Cut off or malformed: the loop answers it with an error result.
+                block["input"] = {}
+                invalid_tool_use_ids.add(str(block.get("id")))
+                return
+            block["input"] = tool_input
+            if on_tool_use:
+                on_tool_use(block)
+
+    with contextlib.closing(_anthropic_open("/v1/messages", {**body, "stream": True}, api_key, preencoded=preencoded)) as resp:
+        for data in _iter_sse_data(resp.iter_lines()):
+            event = _json_loads(data)
+            kind = event.get("type")
+            if kind == "content_block_start":
+                index = event.get("index", len(blocks))
+                blocks[index] = dict(event.get("content_block") or {})
+                pieces[index] = []
+            elif kind == "content_block_delta":
+                index = event.get("index")
+                delta = event.get("delta") or {}
+                if index not in pieces:
+                    continue
+                if delta.get("type") == "text_delta":
+                    text = delta.get("text", "")
+                    pieces[index].append(text)
+                elif delta.get("type") == "input_json_delta":
+                    pieces[index].append(delta.get("partial_json", ""))
+            elif kind == "content_block_stop":
+                close_block(event.get("index"))
+            elif kind == "message_delta":
+                stop_reason = (event.get("delta") or {}).get("stop_reason") or stop_reason
+            elif kind == "error":
+                error = event.get("error") or {}
+                detail = str(error.get("message") or error)
+                transient = error.get("type") == "overloaded_error" or _is_transient_anthropic_detail(detail)
+                raise (_TransientStreamError if transient else RuntimeError)(
+                    f"Anthropic stream error: {detail[:300]}"
+                )
+
+    for index in list(pieces):
+        close_block(index)
+    return {
+        "content": [blocks[i] for i in sorted(blocks)],
+        "stop_reason": stop_reason,
+        "invalid_tool_use_ids": invalid_tool_use_ids,
+    }
+
+
+_TRANSIENT_DETAIL_RE = re.compile(
+    r"timed out|timeout|interrupted|overloaded|try again|long requests", re.IGNORECASE
+)
+
+
+def _is_transient_anthropic_detail(detail: str) -> bool:
+    return bool(detail) and _TRANSIENT_DETAIL_RE.search(detail) is not None
+
+
+@lru_cache(maxsize=32)
+def _gemini_path(model: str, method: str, query: str) -> str:
+    """Request path for one model/method; the key travels in a header so it stays out of the cache."""
+    path = f"/v1beta/models/{urllib.parse.quote(model, safe='')}:{method}"
+    return f"{path}?{query}" if query else path
+
+
+def _gemini_open(
+    model: str,
+    method: str,
+    body: dict[str, Any],
+    api_key: str,
+    *,
+    query: str = "",
+    preencoded: bytes = b"",
+) -> httpx.Response:
+    """POST to Gemini with retry/backoff and return the open (unread) response."""
+    client = _http_client("https://generativelanguage.googleapis.com", 120)
+    url = _gemini_path(model, method, query)
+    payload = _json_dumpb_with(preencoded, body)
+    headers = {"x-goog-api-key": api_key, "content-type": "application/json"}
+    attempts = GEMINI_HTTP_RETRIES + 1
+    last_error: Exception | None = None
+    for attempt in range(attempts):
+        req = client.build_request("POST", url, content=payload, headers=headers)
+        try:
+            resp = client.send(req, stream=True)
+        except httpx.TransportError as exc:
+            if attempt < attempts - 1:
+                _backoff_sleep(GEMINI_HTTP_BACKOFF_SECONDS, attempt)
+                continue
+            last_error = RuntimeError(f"Gemini request failed: {str(exc)[:300]}")
+            break
+        if resp.status_code < 400:
+            return resp
+        try:
+            detail = resp.read().decode("utf-8", errors="ignore")
+        finally:
+            resp.close()
+        if resp.status_code in {408, 429, 500, 502, 503, 504} and attempt < attempts - 1:
+            _backoff_sleep(GEMINI_HTTP_BACKOFF_SECONDS, attempt)
+            continue
+        last_error = RuntimeError(f"Gemini HTTP {resp.status_code}: {detail[:300]}")
+        break
+    assert last_error is not None
+    raise last_error
 
 
 def _gemini_post(model: str, body: dict[str, Any], api_key: str) -> dict[str, Any]:
-    encoded_model = urllib.parse.quote(model, safe="")
-    req = urllib.request.Request(
-        f"https://generativelanguage.googleapis.com/v1beta/models/{encoded_model}:generateContent?key={api_key}",
-        data=json.dumps(body).encode("utf-8"),
-        method="POST",
-        headers={"content-type": "application/json"},
+    with contextlib.closing(_gemini_open(model, "generateContent", body, api_key)) as resp:
+        return _json_loads(resp.read())
+
+
+def _gemini_stream(
+    model: str,
+    body: dict[str, Any],
+    api_key: str,
+    *,
+    on_text: Callable[[str], None] | None = None,
+    on_function_call: Callable[[dict[str, Any]], None] | None = None,
+    stop: Callable[[], bool] | None = None,
+    preencoded: bytes = b"",
+) -> dict[str, Any]:
+    """Stream generateContent over SSE, forwarding text deltas as they arrive.
+
+    ``on_function_call`` receives each functionCall as soon as its chunk lands
+    (Gemini never splits a call across chunks). ``stop`` is checked after each
+    chunk; once it returns True the rest of the stream is not read.
+    ``preencoded`` holds body members serialized ahead of time.
+
+    Chunks are merged back into a single generateContent-shaped response:
+    consecutive plain text parts are joined, other parts are kept as sent.
+    """
+    committed = False
+
+    def forward_text(text: str) -> None:
+        nonlocal committed
+        committed = True
+        on_text(text)
+
+    def forward_function_call(call: dict[str, Any]) -> None:
+        nonlocal committed
+        committed = True
+        on_function_call(call)
+
+    return _retry_stream(
+        "Gemini",
+        GEMINI_HTTP_RETRIES,
+        GEMINI_HTTP_BACKOFF_SECONDS,
+        lambda: _gemini_stream_attempt(
+            model,
+            body,
+            api_key,
+            on_text=forward_text if on_text else None,
+            on_function_call=forward_function_call if on_function_call else None,
+            stop=stop,
+            preencoded=preencoded,
+        ),
+        lambda: committed,
     )
-    try:
-        with urllib.request.urlopen(req, timeout=120) as resp:
-            return json.loads(resp.read().decode("utf-8"))
-    except urllib.error.HTTPError as exc:
-        detail = exc.read().decode("utf-8", errors="ignore")
-        raise RuntimeError(f"Gemini HTTP {exc.code}: {detail[:300]}") from exc
+
+
+def _gemini_stream_attempt(
+    model: str,
+    body: dict[str, Any],
+    api_key: str,
+    *,
+    on_text: Callable[[str], None] | None,
+    on_function_call: Callable[[dict[str, Any]], None] | None,
+    stop: Callable[[], bool] | None,
+    preencoded: bytes,
+) -> dict[str, Any]:
+    parts: list[dict[str, Any]] = []
+    text_run: list[str] = []
+    text_is_thought = False
+    finish_reason: str | None = None
+    prompt_feedback: dict[str, Any] | None = None
+    saw_candidate = False
+
+    def flush_text() -> None:
+        if text_run:
+            part: dict[str, Any] = {"text": "".join(text_run)}
+            if text_is_thought:
+                part["thought"] = True
+            parts.append(part)
+            text_run.clear()
+
+    with contextlib.closing(_gemini_open(
+        model, "streamGenerateContent", body, api_key, query="alt=sse", preencoded=preencoded
+    )) as resp:
+        for data in _iter_sse_data(resp.iter_lines()):
+            chunk = _json_loads(data)
+            if isinstance(chunk.get("error"), dict):
+                error = chunk["error"]
+                transient = error.get("code") in {408, 429, 500, 502, 503, 504}
+                raise (_TransientStreamError if transient else RuntimeError)(
+                    f"Gemini stream error: {str(error.get('message') or error)[:300]}"
+                )
+            if isinstance(chunk.get("promptFeedback"), dict):
+                prompt_feedback = chunk["promptFeedback"]
+            candidates = chunk.get("candidates")
+            if not isinstance(candidates, list) or not candidates or not isinstance(candidates[0], dict):
+                continue
+            saw_candidate = True
+            candidate = candidates[0]
+            finish_reason = candidate.get("finishReason") or finish_reason
+            content = candidate.get("content") if isinstance(candidate.get("content"), dict) else {}
+            for part in content.get("parts") or ():
+                if not isinstance(part, dict):
+                    continue
+                text = part.get("text")
+                if isinstance(text, str) and part.keys() <= {"text", "thought"}:
+                    thought = bool(part.get("thought"))
+                    if thought != text_is_thought:
+                        flush_text()
+                        text_is_thought = thought
+                    text_run.append(text)
+                    if on_text and text and not thought:
+                        on_text(text)
+                    continue
+                flush_text()
+                parts.append(part)
+                if on_function_call and isinstance(part.get("functionCall"), dict):
+                    on_function_call(part["functionCall"])
+            if stop is not None and stop():
+                break
+    flush_text()
+
+    result: dict[str, Any] = {}
+    if saw_candidate:
+        result["candidates"] = [{"content": {"role": "model", "parts": parts}, "finishReason": finish_reason}]
+    if prompt_feedback is not None:
+        result["promptFeedback"] = prompt_feedback
+    return result
 
 
 def _clamp(value: object, default: int) -> int:
-    try:
-        v = int(float(value)) if value is not None else default
-    except (TypeError, ValueError):
-        v = default
+    # Decoded JSON numbers are the common case; only strings need parsing.
+    if type(value) is int:
+        v = value
+    else:
+        try:
+            v = int(value if type(value) is float else float(value)) if value is not None else default
+        except (TypeError, ValueError, OverflowError):
+            v = default
     return max(100, min(1600, v))
 
 
 def _coerce_float(value: object, default: float = 0.0) -> float:
+    if type(value) is float:
+        return value
+    if type(value) is int:
+        return float(value)
     try:
         return float(value) if value is not None else default
     except (TypeError, ValueError):
         return default
 
 
+# Accepted spellings -> canonical value; anything else gets the default.
+_COORDINATE_SPACES = {
+    "viewport_offset": "viewport_center_offset",
+    "viewport_center_offset": "viewport_center_offset",
+    "viewport_center": "viewport_center_offset",
+    "viewport_local": "viewport_local",
+    "viewport_top_left": "viewport_local",
+    "viewport_topleft": "viewport_local",
+    "canvas_absolute": "canvas_absolute",
+    "document_axis": "document_axis",
+}
+_ANCHORS = {"top_left": "top_left", "center": "center"}
+
+
 def _normalize_coordinate_space(value: object) -> str:
-    raw = str(value or "viewport_offset").strip().lower()
-    if raw in {"viewport_offset", "viewport_center_offset", "viewport_center"}:
-        return "viewport_center_offset"
-    if raw in {"viewport_local", "viewport_top_left", "viewport_topleft"}:
-        return "viewport_local"
-    if raw in {"canvas_absolute", "document_axis"}:
-        return raw
-    return "viewport_center_offset"
+    return _COORDINATE_SPACES.get(str(value or "").strip().lower(), "viewport_center_offset")
 
 
 def _normalize_anchor(value: object) -> str:
-    raw = str(value or "top_left").strip().lower()
-    if raw in {"top_left", "center"}:
-        return raw
-    return "top_left"
+    return _ANCHORS.get(str(value or "").strip().lower(), "top_left")
+
+
+_HTML_MARKUP_RE = re.compile(r"<(?:html|body|div|p|span|table|!doctype)", re.IGNORECASE)
+# Markdown structure (fences, headings, lists, tables, emphasis) or LaTeX.
+_MARKDOWN_OR_LATEX_RE = re.compile(
+    r"```|\n(?:#{1,2} |[-*] |1\. )|\|---|\*\*|__"
+    r"|\$\$|\\[()\[\]]|\\(?:frac|sum|int|sqrt)"
+)
 
 
 def _looks_like_html_markup(text: str) -> bool:
-    t = (text or "").strip().lower()
-    if not t:
-        return False
-    return (
-        "<html" in t
-        or "<body" in t
-        or "<div" in t
-        or "<p" in t
-        or "<span" in t
-        or "<table" in t
-        or "<!doctype" in t
-    )
+    return bool(text) and _HTML_MARKUP_RE.search(text) is not None
 
 
 def _looks_like_markdown_or_latex(text: str) -> bool:
     t = (text or "").strip()
     if not t:
         return False
-    markdown_signals = [
-        "```",
-        "\n# ",
-        "\n## ",
-        "\n- ",
-        "\n* ",
-        "\n1. ",
-        "|---",
-        "**",
-        "__",
-    ]
-    latex_signals = ["$$", "\\(", "\\)", "\\[", "\\]", "\\frac", "\\sum", "\\int", "\\sqrt"]
-    if any(sig in t for sig in markdown_signals):
-        return True
-    if any(sig in t for sig in latex_signals):
+    if _MARKDOWN_OR_LATEX_RE.search(t):
         return True
     # Single-dollar inline math is common in model outputs.
-    if t.count("$") >= 2:
-        return True
-    return False
+    return t.count("$") >= 2
+
+
+# Larger sources are rendered uncached, so the memo never pins huge pages.
+DOCUMENT_CACHE_MAX_SOURCE_CHARS = 200_000
 
 
 def _render_document_html(source: str) -> str:
     """Render Markdown + LaTeX source into a self-contained HTML document."""
-    escaped = html_module.escape(source)
-    return f"""\
+    if len(source) > DOCUMENT_CACHE_MAX_SOURCE_CHARS:
+        return _document_html(source)
+    return _document_html_cached(source)
+
+
+def _document_html(source: str) -> str:
+    return _DOCUMENT_HTML_PREFIX + html_module.escape(source) + _DOCUMENT_HTML_SUFFIX
+
+
+_document_html_cached = lru_cache(maxsize=64)(_document_html)
+
+
+# Static shell around the escaped source; markdown/KaTeX run client-side.
+_DOCUMENT_HTML_PREFIX = """\
 <!DOCTYPE html>
 <html lang="en">
 <head>
@@ -1259,107 +2177,153 @@ def _render_document_html(source: str) -> str:
 <link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/katex@0.16.11/dist/katex.min.css">
 <link rel="stylesheet" href="https://cdn.jsdelivr.net/gh/highlightjs/cdn-release@11.9.0/build/styles/github-dark.min.css">
 <style>
-  :root {{ color-scheme: dark; }}
-  * {{ margin: 0; padding: 0; box-sizing: border-box; }}
-  body {{
+  :root { color-scheme: dark; }
+  * { margin: 0; padding: 0; box-sizing: border-box; }
+  body {
     font-family: "New York", "Iowan Old Style", Georgia, serif;
     font-size: 15px; line-height: 1.7; color: #e4e4e7;
     background: #18181b; padding: 24px 28px;
     -webkit-font-smoothing: antialiased;
-  }}
-  h1, h2, h3, h4, h5, h6 {{
+  }
+  h1, h2, h3, h4, h5, h6 {
     font-family: -apple-system, BlinkMacSystemFont, "SF Pro Display", system-ui, sans-serif;
     color: #fafafa; margin: 1.4em 0 0.5em; line-height: 1.3;
-  }}
-  h1 {{ font-size: 1.6em; font-weight: 700; }}
-  h2 {{ font-size: 1.3em; font-weight: 600; }}
-  h3 {{ font-size: 1.1em; font-weight: 600; }}
-  p {{ margin: 0.6em 0; }}
-  a {{ color: #60a5fa; text-decoration: none; }}
-  a:hover {{ text-decoration: underline; }}
-  code {{
+  }
+  h1 { font-size: 1.6em; font-weight: 700; }
+  h2 { font-size: 1.3em; font-weight: 600; }
+  h3 { font-size: 1.1em; font-weight: 600; }
+  p { margin: 0.6em 0; }
+  a { color: #60a5fa; text-decoration: none; }
+  a:hover { text-decoration: underline; }
+  code {
     font-family: "SF Mono", Menlo, monospace; font-size: 0.88em;
     background: #27272a; padding: 2px 6px; border-radius: 4px;
-  }}
-  pre {{ margin: 1em 0; border-radius: 8px; overflow-x: auto; }}
-  pre code {{
+  }
+  pre { margin: 1em 0; border-radius: 8px; overflow-x: auto; }
+  pre code {
     display: block; padding: 14px 18px;
     background: #1e1e22; line-height: 1.5;
-  }}
-  blockquote {{
+  }
+  blockquote {
     border-left: 3px solid #3f3f46; padding-left: 16px;
     color: #a1a1aa; margin: 1em 0;
-  }}
-  ul, ol {{ margin: 0.6em 0; padding-left: 1.5em; }}
-  li {{ margin: 0.25em 0; }}
-  table {{ border-collapse: collapse; margin: 1em 0; width: 100%; }}
-  th, td {{
+  }
+  ul, ol { margin: 0.6em 0; padding-left: 1.5em; }
+  li { margin: 0.25em 0; }
+  table { border-collapse: collapse; margin: 1em 0; width: 100%; }
+  th, td {
     border: 1px solid #3f3f46; padding: 8px 12px; text-align: left;
-  }}
-  th {{ background: #27272a; font-weight: 600; }}
-  hr {{ border: none; border-top: 1px solid #3f3f46; margin: 1.5em 0; }}
-  .katex-display {{ margin: 1em 0; overflow-x: auto; }}
+  }
+  th { background: #27272a; font-weight: 600; }
+  hr { border: none; border-top: 1px solid #3f3f46; margin: 1.5em 0; }
+  .katex-display { margin: 1em 0; overflow-x: auto; }
 </style>
 </head>
 <body>
-<script type="text/template" id="source">{escaped}</script>
+<script type="text/template" id="source">"""
+_DOCUMENT_HTML_SUFFIX = """</script>
 <div id="content"></div>
 <script src="https://cdn.jsdelivr.net/npm/marked@14.0.0/marked.min.js"></script>
 <script src="https://cdn.jsdelivr.net/gh/highlightjs/cdn-release@11.9.0/build/highlight.min.js"></script>
 <script src="https://cdn.jsdelivr.net/npm/katex@0.16.11/dist/katex.min.js"></script>
 <script src="https://cdn.jsdelivr.net/npm/katex@0.16.11/dist/contrib/auto-render.min.js"></script>
 <script>
-(function() {{
-  function normalizeMathSource(src) {{
+(function() {
+  function normalizeMathSource(src) {
     // Wrap bare LaTeX environments (e.g. bmatrix/aligned) in $$...$$ so KaTeX autorender sees them.
-    // This helps when models emit \\begin{{...}} blocks without delimiters.
+    // This helps when models emit \\begin{...} blocks without delimiters.
     return src.replace(
-      /(^|\\n)(\\s*\\\\begin\\{{[a-zA-Z*]+\\}}[\\s\\S]*?\\\\end\\{{[a-zA-Z*]+\\}}\\s*)(?=\\n|$)/g,
-      function(_, prefix, block) {{
+      /(^|\\n)(\\s*\\\\begin\\{[a-zA-Z*]+\\}[\\s\\S]*?\\\\end\\{[a-zA-Z*]+\\}\\s*)(?=\\n|$)/g,
+      function(_, prefix, block) {
         var trimmed = block.trim();
-        if (trimmed.startsWith("$$") || trimmed.startsWith("\\\\[") || trimmed.startsWith("\\\\(")) {{
+        if (trimmed.startsWith("$$") || trimmed.startsWith("\\\\[") || trimmed.startsWith("\\\\(")) {
           return prefix + block;
-        }}
+        }
         return prefix + "\\n$$\\n" + trimmed + "\\n$$\\n";
-      }}
+      }
     );
-  }}
+  }
 
-  marked.setOptions({{
-    highlight: function(code, lang) {{
-      if (lang && hljs.getLanguage(lang)) {{
-        return hljs.highlight(code, {{ language: lang }}).value;
-      }}
+  marked.setOptions({
+    highlight: function(code, lang) {
+      if (lang && hljs.getLanguage(lang)) {
+        return hljs.highlight(code, { language: lang }).value;
+      }
       return hljs.highlightAuto(code).value;
-    }}
-  }});
+    }
+  });
   var src = document.getElementById("source").textContent;
   src = normalizeMathSource(src);
   var el = document.getElementById("content");
   el.innerHTML = marked.parse(src);
-  if (typeof renderMathInElement === "function") {{
-    renderMathInElement(el, {{
+  if (typeof renderMathInElement === "function") {
+    renderMathInElement(el, {
       delimiters: [
-        {{ left: "$$", right: "$$", display: true }},
-        {{ left: "\\\\[", right: "\\\\]", display: true }},
-        {{ left: "$", right: "$", display: false }},
-        {{ left: "\\\\(", right: "\\\\)", display: false }}
+        { left: "$$", right: "$$", display: true },
+        { left: "\\\\[", right: "\\\\]", display: true },
+        { left: "$", right: "$", display: false },
+        { left: "\\\\(", right: "\\\\)", display: false }
       ],
       throwOnError: false
-    }});
-  }}
-}})();
+    });
+  }
+})();
 </script>
 </body>
 </html>"""
 
 
+# Successful d2/manim renders keyed by a digest of their source. Failures are
+# never stored, so a transient error is retried on the next push.
+RENDER_CACHE_MAX_ENTRIES = 32
+RENDER_CACHE_MAX_HTML_CHARS = 16 * 1024 * 1024
+RENDER_CACHE_MAX_TOTAL_CHARS = 64 * 1024 * 1024
+_render_cache: OrderedDict[bytes, dict[str, Any]] = OrderedDict()
+_render_cache_chars = 0
+_render_cache_lock = threading.Lock()
+
+
+def _render_cache_key(kind: str, source: str) -> bytes:
+    return hashlib.blake2b(f"{kind}\0{source}".encode("utf-8"), digest_size=16).digest()
+
+
+def _render_cache_get(key: bytes) -> dict[str, Any] | None:
+    with _render_cache_lock:
+        hit = _render_cache.get(key)
+        if hit is not None:
+            _render_cache.move_to_end(key)
+        return hit
+
+
+def _render_cache_size(rendered: dict[str, Any]) -> int:
+    return len(rendered["html"]) + len(rendered.get("svg") or "")
+
+
+def _render_cache_put(key: bytes, rendered: dict[str, Any]) -> dict[str, Any]:
+    """Memoize a render, evicting least-recently-used entries past the count or total-size cap."""
+    global _render_cache_chars
+    if len(rendered["html"]) <= RENDER_CACHE_MAX_HTML_CHARS:
+        with _render_cache_lock:
+            previous = _render_cache.pop(key, None)
+            if previous is not None:
+                _render_cache_chars -= _render_cache_size(previous)
+            _render_cache[key] = rendered
+            _render_cache_chars += _render_cache_size(rendered)
+            while len(_render_cache) > RENDER_CACHE_MAX_ENTRIES or _render_cache_chars > RENDER_CACHE_MAX_TOTAL_CHARS:
+                _render_cache_chars -= _render_cache_size(_render_cache.popitem(last=False)[1])
+    return rendered
+
+
 def _render_diagram_html(source: str) -> dict[str, Any]:
     """Render D2 diagram source to SVG via the d2 CLI, wrapped in dark HTML.
 
     Returns {"html": str, "width": int, "height": int}.
     """
-    d2_bin = shutil.which("d2")
+    cache_key = _render_cache_key("diagram", source)
+    if (cached := _render_cache_get(cache_key)) is not None:
+        return cached
+
+    d2_bin = _d2_binary()
     if not d2_bin:
         return {"html": _diagram_error_html("d2 binary not found in PATH. Install from https://d2lang.com"),
                 "width": 400, "height": 180}
@@ -1405,11 +2369,18 @@ def _render_diagram_html(source: str) -> dict[str, Any]:
             return {"html": _diagram_error_html(f"d2 error (exit {result.returncode}):\n{stderr}"),
                     "width": 400, "height": 180}
 
-    svg = result.stdout.decode("utf-8")
+    svg_bytes = result.stdout
+    # Drop the CompletedProcess objects so the SVG bytes are freed as soon
+    # as they are decoded, before the page copy is built.
+    result = retry = None
 
-    # Extract natural dimensions from the SVG viewBox
+    # Extract natural dimensions from the root <svg> tag's viewBox; the scan
+    # runs on the raw bytes and stops at the end of that tag instead of
+    # walking the path data.
     svg_w, svg_h = 320, 220
-    vb = re.search(r'viewBox="[\d.\-]+ [\d.\-]+ ([\d.]+) ([\d.]+)"', svg)
+    tag_start = svg_bytes.find(b"<svg")
+    tag_end = svg_bytes.find(b">", tag_start) if tag_start != -1 else -1
+    vb = _SVG_VIEWBOX_RE.search(svg_bytes, tag_start, tag_end) if tag_end != -1 else None
     if vb:
         try:
             svg_w = int(float(vb.group(1)))
@@ -1421,28 +2392,45 @@ def _render_diagram_html(source: str) -> dict[str, Any]:
     widget_w = svg_w + 32
     widget_h = svg_h + 32
 
-    html = f"""\
+    svg = svg_bytes.decode("utf-8")
+    del svg_bytes
+    html = _DIAGRAM_HTML_PREFIX + svg + _DIAGRAM_HTML_SUFFIX
+    return _render_cache_put(cache_key, {"html": html, "width": widget_w, "height": widget_h, "svg": svg})
+
+
+_DIAGRAM_HTML_PREFIX = """\
 <!DOCTYPE html>
 <html lang="en">
 <head>
 <meta charset="utf-8">
 <meta name="viewport" content="width=device-width, initial-scale=1, maximum-scale=1, user-scalable=no">
 <style>
-  :root {{ color-scheme: dark; }}
-  * {{ margin: 0; padding: 0; box-sizing: border-box; }}
-  body {{
+  :root { color-scheme: dark; }
+  * { margin: 0; padding: 0; box-sizing: border-box; }
+  body {
     background: #18181b; display: flex;
     align-items: center; justify-content: center;
     min-height: 100vh; padding: 16px;
-  }}
-  svg {{ max-width: 100%; height: auto; }}
+  }
+  svg { max-width: 100%; height: auto; }
 </style>
 </head>
 <body>
-{svg}
+"""
+_DIAGRAM_HTML_SUFFIX = """
 </body>
 </html>"""
-    return {"html": html, "width": widget_w, "height": widget_h, "svg": svg}
+
+
+_d2_bin_path: str | None = None
+
+
+def _d2_binary() -> str | None:
+    """Locate the d2 CLI once; misses are not cached so a later install is picked up."""
+    global _d2_bin_path
+    if _d2_bin_path is None:
+        _d2_bin_path = shutil.which("d2")
+    return _d2_bin_path
 
 
 def _run_d2(d2_bin: str, source: str) -> subprocess.CompletedProcess[bytes]:
@@ -1454,48 +2442,65 @@ def _run_d2(d2_bin: str, source: str) -> subprocess.CompletedProcess[bytes]:
     )
 
 
+_SVG_VIEWBOX_RE = re.compile(rb'viewBox="[\d.\-]+ [\d.\-]+ ([\d.]+) ([\d.]+)"')
+_D2_INVALID_STYLE_RE = re.compile(r"invalid style keyword", re.IGNORECASE)
+# `style.<field>: ...` and `style: <value>` lines (but not `style: {` blocks).
+_D2_STYLE_LINE_RE = re.compile(
+    r"^\s*style(?:\.[\w-]+\s*:\s*[^\n]*|\s*:\s*[^\n{][^\n]*)\n?",
+    re.MULTILINE | re.IGNORECASE,
+)
+_D2_STYLE_BLOCK_RE = re.compile(r"\bstyle\s*:\s*\{", re.IGNORECASE)
+# Every style construct contains this word, so one cheap scan can rule them all out.
+_D2_STYLE_WORD_RE = re.compile(r"style", re.IGNORECASE)
+
+
 def _is_d2_invalid_style_error(stderr: str) -> bool:
-    return "invalid style keyword" in stderr.lower()
+    return _D2_INVALID_STYLE_RE.search(stderr) is not None
 
 
 def _strip_d2_style_constructs(source: str) -> str:
+    if not _D2_STYLE_WORD_RE.search(source):
+        return source
     stripped = _strip_d2_style_blocks(source)
     # Remove line-level style assignments that are common LLM mistakes.
-    stripped = re.sub(r"(?mi)^\s*style\.[\w-]+\s*:\s*[^\n]*\n?", "", stripped)
-    stripped = re.sub(r"(?mi)^\s*style\s*:\s*[^\n{][^\n]*\n?", "", stripped)
-    return stripped
+    return _D2_STYLE_LINE_RE.sub("", stripped)
 
 
 def _strip_d2_style_blocks(source: str) -> str:
-    out: list[str] = []
+    if not _D2_STYLE_BLOCK_RE.search(source):
+        return source
+    # (start, end) ranges of source to keep; sliced and joined once at the end.
+    spans: list[tuple[int, int]] = []
     i = 0
     n = len(source)
 
     while i < n:
-        match = re.search(r"\bstyle\s*:\s*\{", source[i:], flags=re.IGNORECASE)
+        match = _D2_STYLE_BLOCK_RE.search(source, i)
         if not match:
-            out.append(source[i:])
+            spans.append((i, n))
             break
 
-        start = i + match.start()
-        brace_start = i + match.end() - 1  # points at "{"
-        out.append(source[i:start])
+        start = match.start()
+        brace_start = match.end() - 1  # points at "{"
+        spans.append((i, start))
 
-        depth = 0
-        j = brace_start
-        while j < n:
-            ch = source[j]
-            if ch == "{":
+        # Jump between braces with str.find instead of stepping per character.
+        depth = 1
+        j = brace_start + 1
+        while depth:
+            close_at = source.find("}", j)
+            if close_at == -1:
+                break
+            open_at = source.find("{", j, close_at)
+            if open_at != -1:
                 depth += 1
-            elif ch == "}":
+                j = open_at + 1
+            else:
                 depth -= 1
-                if depth == 0:
-                    j += 1
-                    break
-            j += 1
+                j = close_at + 1
 
-        if j >= n:
-            # Unbalanced block; drop to end.
+        if depth or j >= n:
+            # Unbalanced block (or nothing left after it); drop to end.
             i = n
             break
 
@@ -1505,47 +2510,168 @@ def _strip_d2_style_blocks(source: str) -> str:
             j += 1
         i = j
 
-    return "".join(out)
+    return "".join([source[a:b] for a, b in spans])
 
 
+@lru_cache(maxsize=64)
 def _diagram_error_html(message: str) -> str:
     """Fallback HTML showing a diagram rendering error."""
-    escaped = html_module.escape(message)
-    return f"""\
+    # Text content of <pre>, so quotes need no escaping.
+    return _DIAGRAM_ERROR_HTML_PREFIX + html_module.escape(message, quote=False) + _ERROR_HTML_SUFFIX
+
+
+# Render-error pages share one layout; the per-kind heads are filled in once here.
+_ERROR_HTML_PREFIX_TEMPLATE = string.Template("""\
 <!DOCTYPE html>
 <html lang="en">
 <head>
 <meta charset="utf-8">
 <style>
-  :root {{ color-scheme: dark; }}
-  body {{
+  :root { color-scheme: dark; }
+  body {
     background: #18181b; color: #fca5a5;
     font-family: -apple-system, BlinkMacSystemFont, system-ui, sans-serif;
     font-size: 14px; padding: 24px;
     display: flex; align-items: center; justify-content: center;
     min-height: 100vh;
-  }}
-  .error-box {{
+  }
+  .error-box {
     background: #27171a; border: 1px solid #991b1b;
-    border-radius: 10px; padding: 20px 24px; max-width: 480px;
-  }}
-  .error-box h3 {{
+    border-radius: 10px; padding: 20px 24px; max-width: $max_width;
+  }
+  .error-box h3 {
     margin: 0 0 8px; font-size: 15px; font-weight: 600; color: #fecaca;
-  }}
-  .error-box pre {{
+  }
+  .error-box pre {
     margin: 0; font-family: "SF Mono", Menlo, monospace;
     font-size: 12px; white-space: pre-wrap; word-break: break-word;
     color: #fca5a5;
-  }}
+  }
 </style>
 </head>
 <body>
 <div class="error-box">
-  <h3>Diagram Rendering Failed</h3>
-  <pre>{escaped}</pre>
+  <h3>$title</h3>
+  <pre>""")
+_ERROR_HTML_SUFFIX = """</pre>
 </div>
 </body>
 </html>"""
+_DIAGRAM_ERROR_HTML_PREFIX = _ERROR_HTML_PREFIX_TEMPLATE.substitute(
+    title="Diagram Rendering Failed", max_width="480px"
+)
+
+
+_manim_bin_path: str | None = None
+_tex_bin_path: str | None = None
+
+
+def _manim_binary() -> str | None:
+    """Prefer the venv's manim, fall back to PATH.
+
+    Only a hit is remembered, so installing manim later needs no restart.
+    """
+    global _manim_bin_path
+    if _manim_bin_path is None:
+        venv_manim = Path(__file__).resolve().parent / ".venv" / "bin" / "manim"
+        _manim_bin_path = str(venv_manim) if venv_manim.is_file() else shutil.which("manim")
+    return _manim_bin_path
+
+
+def _tex_bin_dir() -> str | None:
+    """First installed TeX bin directory, if any; misses are not cached."""
+    global _tex_bin_path
+    if _tex_bin_path is None:
+        home = Path.home()
+        for tex_bin in [
+            home / "Library" / "TinyTeX" / "bin" / "universal-darwin",
+            home / "Library" / "TinyTeX" / "bin" / "x86_64-darwin",
+            Path("/usr/local/texlive/2025/bin/universal-darwin"),
+        ]:
+            if tex_bin.is_dir():
+                _tex_bin_path = str(tex_bin)
+                break
+    return _tex_bin_path
+
+
+# Bounded to the base-class parentheses, so a miss cannot run to the end of
+# each line twice over as the greedy `.*Scene.*` did.
+_MANIM_SCENE_CLASS_RE = re.compile(r'class\s+(\w+)\s*\([^)]*Scene[^)]*\)')
+
+# Rendered MP4s persist across restarts, since a manim run takes 5-90 s.
+_MANIM_CACHE_DIR = Path(
+    os.environ.get("IRIS_MANIM_CACHE_DIR")
+    or Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "iris" / "manim"
+)
+MANIM_CACHE_MAX_BYTES = 512 * 1024 * 1024
+MANIM_CACHE_MAX_AGE_SECONDS = 30 * 24 * 3600
+# Quality and container are part of the cached video's identity.
+_MANIM_RENDER_FLAGS = ("-ql", "--format=mp4")  # low quality: 480p, 15fps — fast
+_manim_version_tag: str | None = None
+
+
+def _manim_version() -> str:
+    """Installed manim version; a missing package is re-checked on the next call."""
+    global _manim_version_tag
+    if _manim_version_tag is None:
+        try:
+            _manim_version_tag = importlib.metadata.version("manim")
+        except importlib.metadata.PackageNotFoundError:
+            return "unknown"
+    return _manim_version_tag
+
+
+def _manim_video_path(source: str) -> Path:
+    """On-disk cache path for a scene, keyed on source, render flags and manim version."""
+    key = hashlib.blake2b(
+        "\0".join((_manim_version(), *_MANIM_RENDER_FLAGS, source)).encode("utf-8"), digest_size=16
+    ).hexdigest()
+    return _MANIM_CACHE_DIR / f"{key}.mp4"
+
+
+# Each manim render saturates a core (and TeX), so concurrent pushes queue for
+# a slot instead of all rendering at once and slowing every one of them down.
+MANIM_MAX_CONCURRENT_RENDERS = max(1, min(2, os.cpu_count() or 1))
+_manim_render_slots = threading.BoundedSemaphore(MANIM_MAX_CONCURRENT_RENDERS)
+
+
+def _store_manim_video(src: Path, dest: Path) -> None:
+    """Copy a rendered MP4 into the on-disk cache (best effort, atomic)."""
+    tmp = dest.with_name(f".{dest.stem}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, dest)
+    except OSError:
+        tmp.unlink(missing_ok=True)
+        return
+    _prune_manim_cache(dest.parent)
+
+
+def _prune_manim_cache(cache_dir: Path) -> None:
+    """Drop cached MP4s past the age cap, then the least recently used past the size cap."""
+    cutoff = time.time() - MANIM_CACHE_MAX_AGE_SECONDS
+    videos: list[tuple[float, int, str]] = []
+    try:
+        with os.scandir(cache_dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".mp4"):
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                videos.append((st.st_mtime, st.st_size, entry.path))
+    except OSError:
+        return
+    videos.sort()
+    total = sum(size for _, size, _ in videos)
+    for mtime, size, path in videos:
+        if mtime >= cutoff and total <= MANIM_CACHE_MAX_BYTES:
+            break
+        with contextlib.suppress(OSError):
+            os.unlink(path)
+            total -= size
 
 
 def _render_animation_html(source: str) -> dict[str, Any]:
@@ -1553,51 +2679,58 @@ def _render_animation_html(source: str) -> dict[str, Any]:
 
     Returns {"html": str, "width": int, "height": int}.
     """
-    # Prefer the venv's manim, fall back to PATH
-    venv_manim = Path(__file__).resolve().parent / ".venv" / "bin" / "manim"
-    manim_bin = str(venv_manim) if venv_manim.is_file() else shutil.which("manim")
+    cache_key = _render_cache_key("animation", source)
+    if (cached := _render_cache_get(cache_key)) is not None:
+        return cached
+
+    video_path = _manim_video_path(source)
+    try:
+        mp4_file = video_path.open("rb")
+    except OSError:
+        pass
+    else:
+        # A hit counts as a use, so size eviction drops the coldest videos.
+        with contextlib.suppress(OSError):
+            os.utime(video_path)
+        return _render_cache_put(cache_key, _animation_widget(mp4_file))
+
+    manim_bin = _manim_binary()
     if not manim_bin:
         return {"html": _animation_error_html("manim not found. Run: cd backend && uv sync"),
                 "width": 480, "height": 200}
 
     # Extract the Scene class name from source
-    match = re.search(r'class\s+(\w+)\s*\(.*Scene.*\)', source)
+    match = _MANIM_SCENE_CLASS_RE.search(source)
     if not match:
         return {"html": _animation_error_html("No Scene subclass found in source. Define a class like:\n\nclass MyScene(Scene):\n    def construct(self): ..."),
                 "width": 480, "height": 200}
     scene_name = match.group(1)
 
-    with tempfile.TemporaryDirectory(prefix="iris_manim_") as tmpdir:
+    with tempfile.TemporaryDirectory(prefix="iris_manim_", ignore_cleanup_errors=True) as tmpdir:
         scene_file = Path(tmpdir) / "scene.py"
         scene_file.write_text(source, encoding="utf-8")
 
         # Ensure TeX binaries (dvisvgm, etc.) are on PATH
         env = os.environ.copy()
-        home = Path.home()
-        for tex_bin in [
-            home / "Library" / "TinyTeX" / "bin" / "universal-darwin",
-            home / "Library" / "TinyTeX" / "bin" / "x86_64-darwin",
-            Path("/usr/local/texlive/2025/bin/universal-darwin"),
-        ]:
-            if tex_bin.is_dir():
-                env["PATH"] = f"{tex_bin}:{env.get('PATH', '')}"
-                break
+        tex_bin = _tex_bin_dir()
+        if tex_bin:
+            env["PATH"] = f"{tex_bin}:{env.get('PATH', '')}"
 
         try:
-            result = subprocess.run(
-                [
-                    manim_bin, "render",
-                    "-ql",              # low quality: 480p, 15fps — fast
-                    "--format=mp4",
-                    "--media_dir", tmpdir,
-                    str(scene_file),
-                    scene_name,
-                ],
-                capture_output=True,
-                timeout=90,
-                cwd=tmpdir,
-                env=env,
-            )
+            with _manim_render_slots:
+                result = subprocess.run(
+                    [
+                        manim_bin, "render",
+                        *_MANIM_RENDER_FLAGS,
+                        "--media_dir", tmpdir,
+                        str(scene_file),
+                        scene_name,
+                    ],
+                    capture_output=True,
+                    timeout=90,
+                    cwd=tmpdir,
+                    env=env,
+                )
         except subprocess.TimeoutExpired:
             return {"html": _animation_error_html("Manim render timed out (90s limit). Simplify the animation."),
                     "width": 480, "height": 200}
@@ -1619,81 +2752,87 @@ def _render_animation_html(source: str) -> dict[str, Any]:
             return {"html": _animation_error_html("Manim produced no output file. Check that construct() creates animations."),
                     "width": 480, "height": 200}
 
-        mp4_path = mp4_files[0]
-        video_b64 = base64.b64encode(mp4_path.read_bytes()).decode("ascii")
+        _store_manim_video(mp4_files[0], video_path)
+        # Hold only an open handle to the MP4: the temp tree (scene source,
+        # partial movie files, TeX cache) is removed on leaving the block,
+        # before encoding starts, and the handle keeps the video readable.
+        mp4_file = mp4_files[0].open("rb")
 
+    return _render_cache_put(cache_key, _animation_widget(mp4_file))
+
+
+def _animation_widget(mp4_file: BinaryIO) -> dict[str, Any]:
+    """Embed an open MP4 into the animation page, closing the handle."""
+    # Widgets reach the devices as standalone HTML strings, so the video
+    # must stay inline; stream-encode it straight into the page instead
+    # of holding raw bytes, a base64 copy and a formatted copy at once.
     # 480p = 854x480
-    html = f"""\
+    with mp4_file:
+        html = "".join(itertools.chain(
+            (_ANIMATION_HTML_PREFIX,),
+            _b64_file_chunks(mp4_file),
+            (_ANIMATION_HTML_SUFFIX,),
+        ))
+    return {"html": html, "width": 854, "height": 480}
+
+
+# Base64 maps 3 input bytes to 4 output chars, so chunks that are a multiple
+# of 3 bytes encode independently and concatenate into one valid payload.
+_B64_FILE_CHUNK_BYTES = 3 * 256 * 1024
+
+
+def _b64_file_chunks(fh: BinaryIO) -> Iterator[str]:
+    """Yield the base64 encoding of a binary file in chunks without reading it whole."""
+    while chunk := fh.read(_B64_FILE_CHUNK_BYTES):
+        yield base64.b64encode(chunk).decode("ascii")
+
+
+_ANIMATION_HTML_PREFIX = """\
 <!DOCTYPE html>
 <html lang="en">
 <head>
 <meta charset="utf-8">
 <meta name="viewport" content="width=device-width, initial-scale=1, maximum-scale=1, user-scalable=no">
 <style>
-  :root {{ color-scheme: dark; }}
-  * {{ margin: 0; padding: 0; box-sizing: border-box; }}
-  body {{
+  :root { color-scheme: dark; }
+  * { margin: 0; padding: 0; box-sizing: border-box; }
+  body {
     background: #18181b; display: flex;
     align-items: center; justify-content: center;
     min-height: 100vh;
-  }}
-  video {{
+  }
+  video {
     max-width: 100%; height: auto; border-radius: 6px;
-  }}
+  }
 </style>
 </head>
 <body>
 <video autoplay loop muted playsinline>
-  <source src="data:video/mp4;base64,{video_b64}" type="video/mp4">
+  <source src="data:video/mp4;base64,"""
+_ANIMATION_HTML_SUFFIX = """" type="video/mp4">
 </video>
 </body>
 </html>"""
-    return {"html": html, "width": 854, "height": 480}
 
 
+@lru_cache(maxsize=64)
 def _animation_error_html(message: str) -> str:
     """Fallback HTML showing a Manim rendering error."""
-    escaped = html_module.escape(message)
-    return f"""\
-<!DOCTYPE html>
-<html lang="en">
-<head>
-<meta charset="utf-8">
-<style>
-  :root {{ color-scheme: dark; }}
-  body {{
-    background: #18181b; color: #fca5a5;
-    font-family: -apple-system, BlinkMacSystemFont, system-ui, sans-serif;
-    font-size: 14px; padding: 24px;
-    display: flex; align-items: center; justify-content: center;
-    min-height: 100vh;
-  }}
-  .error-box {{
-    background: #27171a; border: 1px solid #991b1b;
-    border-radius: 10px; padding: 20px 24px; max-width: 520px;
-  }}
-  .error-box h3 {{
-    margin: 0 0 8px; font-size: 15px; font-weight: 600; color: #fecaca;
-  }}
-  .error-box pre {{
-    margin: 0; font-family: "SF Mono", Menlo, monospace;
-    font-size: 12px; white-space: pre-wrap; word-break: break-word;
-    color: #fca5a5;
-  }}
-</style>
-</head>
-<body>
-<div class="error-box">
-  <h3>Animation Rendering Failed</h3>
-  <pre>{escaped}</pre>
-</div>
-</body>
-</html>"""
+    # Text content of <pre>, so quotes need no escaping.
+    return _ANIMATION_ERROR_HTML_PREFIX + html_module.escape(message, quote=False) + _ERROR_HTML_SUFFIX
+
+
+_ANIMATION_ERROR_HTML_PREFIX = _ERROR_HTML_PREFIX_TEMPLATE.substitute(
+    title="Animation Rendering Failed", max_width="520px"
+)
+
+
+_WIDGET_TYPES = frozenset({"html", "document", "diagram", "animation"})
 
 
 def _normalize_widget_args(args: dict[str, Any]) -> dict[str, Any]:
     widget_type = str(args.get("type") or "html").strip().lower()
-    if widget_type not in {"html", "document", "diagram", "animation"}:
+    if widget_type not in _WIDGET_TYPES:
         widget_type = "html"
 
     source = str(args.get("source") or "")
@@ -1754,34 +2893,30 @@ def _handle_read_widget(args: dict[str, Any]) -> str:
     """Return widget HTML + metadata from the library."""
     name = str(args.get("name") or "").strip().lower()
     if not name:
-        return json.dumps({"error": "Missing 'name' parameter."})
+        return _json_dumps({"error": "Missing 'name' parameter."})
 
     widget_dir = _WIDGETS_DIR / "lib" / name
-    html_path = widget_dir / "widget.html"
-    meta_path = widget_dir / "meta.json"
-
-    if not html_path.is_file():
+    html_mtime_ns = _mtime_ns(widget_dir / "widget.html")
+    if html_mtime_ns < 0:
         # List available widgets to help the agent
-        manifest_path = _WIDGETS_DIR / "lib" / "manifest.json"
-        available = []
-        try:
-            manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
-            available = manifest.get("widgets", [])
-        except (OSError, json.JSONDecodeError):
-            pass
-        return json.dumps({
+        available = _manifest_slugs(_mtime_ns(_WIDGET_MANIFEST_PATH)) or ()
+        return _json_dumps({
             "error": f"Widget '{name}' not found.",
-            "available": available,
+            "available": list(available),
         })
 
-    html_source = html_path.read_text(encoding="utf-8")
-    meta: dict[str, Any] = {}
-    try:
-        meta = json.loads(meta_path.read_text(encoding="utf-8"))
-    except (OSError, json.JSONDecodeError):
-        pass
+    return _load_library_widget(name, html_mtime_ns, _mtime_ns(widget_dir / "meta.json"))
+
+
+@lru_cache(maxsize=128)
+def _load_library_widget(name: str, html_mtime_ns: int, meta_mtime_ns: int) -> str:
+    """Read and serialize one library widget (HTML + meta), re-read only when either file changes."""
+    del html_mtime_ns, meta_mtime_ns  # cache key only
+    widget_dir = _WIDGETS_DIR / "lib" / name
+    html_source = (widget_dir / "widget.html").read_text(encoding="utf-8")
+    meta = _load_widget_meta(name) or {}
 
-    return json.dumps({
+    return _json_dumps({
         "name": meta.get("name", name),
         "description": meta.get("description", ""),
         "defaultWidth": meta.get("defaultWidth", 320),
@@ -1789,7 +2924,7 @@ def _handle_read_widget(args: dict[str, Any]) -> str:
         "accent": meta.get("accent", "#007aff"),
         "tags": meta.get("tags", []),
         "html": html_source,
-    }, ensure_ascii=False)
+    })
 
 
 def _is_browser_session_corrupt(error_text: str) -> bool:
@@ -1807,9 +2942,48 @@ def _is_browser_session_corrupt(error_text: str) -> bool:
     ))
 
 
+@lru_cache(maxsize=1)
+def _browser_use_cli() -> tuple[str, ...]:
+    """Launcher for the browser-use CLI (resolved once per process).
+
+    An installed `browser-use` entry point is exec'd directly; `uvx` is only
+    used as a fallback since it re-resolves the tool environment on every call.
+    """
+    installed = shutil.which("browser-use")
+    if installed:
+        return (installed,)
+    return ("uvx", "browser-use[cli]")
+
+
+_browser_env_lock = threading.Lock()
+_browser_env_cache: tuple[tuple[str, str], dict[str, str]] | None = None
+
+
+def _browser_env() -> dict[str, str]:
+    """Environment for browser-use subprocesses (shared; treat as read-only).
+
+    Copied once and rebuilt only when OPENAI_API_KEY/BROWSER_USE_API_KEY change.
+    """
+    global _browser_env_cache
+    keys = (
+        os.environ.get("OPENAI_API_KEY", ""),
+        os.environ.get("BROWSER_USE_API_KEY", ""),
+    )
+    with _browser_env_lock:
+        if _browser_env_cache is None or _browser_env_cache[0] != keys:
+            env = os.environ.copy()
+            if not keys[1].strip():
+                openai_key = keys[0].strip()
+                if openai_key:
+                    env["BROWSER_USE_API_KEY"] = openai_key
+            _browser_env_cache = (keys, env)
+        return _browser_env_cache[1]
+
+
 def _reset_browser_session(session_name: str, env: dict[str, str]) -> None:
     """Force-close all tabs then stop the browser-use server for a session."""
-    base = ["uvx", "browser-use[cli]", "--session", session_name]
+    _forget_browser_session_state(session_name)
+    base = [*_browser_use_cli(), "--session", session_name]
     try:
         subprocess.run(base + ["close", "--all"], capture_output=True, timeout=15, env=env)
     except Exception:
@@ -1820,12 +2994,25 @@ def _reset_browser_session(session_name: str, env: dict[str, str]) -> None:
         pass
 
 
-def _handle_run_browser_task(
+_BROWSER_COMMAND_CHARS = frozenset("abcdefghijklmnopqrstuvwxyz0123456789-")
+
+
+def _is_valid_browser_command(command: str) -> bool:
+    """Lowercase alphanumerics and dashes, not starting with a dash."""
+    return (
+        bool(command)
+        and command[0] != "-"
+        and all(ch in _BROWSER_COMMAND_CHARS for ch in command)
+    )
+
+
+def _run_browser_task(
     args: dict[str, Any],
     *,
     screenshots: dict[str, bytes] | None = None,
     user_message: str = "",
-) -> str:
+) -> dict[str, Any]:
+    """Run a browser-use CLI command and return the normalized {ok, ...} payload."""
     instruction = str(args.get("instruction") or "").strip()
     start_url = str(args.get("start_url") or "").strip()
     context_text = str(args.get("context_text") or "").strip()
@@ -1847,7 +3034,7 @@ def _handle_run_browser_task(
         max_steps = 12
     max_steps = max(1, min(max_steps, 200))
 
-    cmd: list[str] = ["uvx", "browser-use[cli]", "--json"]
+    cmd: list[str] = [*_browser_use_cli(), "--json"]
     if headed:
         cmd.append("--headed")
     if session_name:
@@ -1867,24 +3054,24 @@ def _handle_run_browser_task(
         command_args = [str(command_args_raw)]
 
     if command:
-        if not re.fullmatch(r"[a-z0-9][a-z0-9-]*", command):
-            return json.dumps({
+        if not _is_valid_browser_command(command):
+            return {
                 "ok": False,
                 "error": f"Invalid browser-use command: {command}",
-            }, ensure_ascii=False)
+            }
 
         if command == "close" and not _user_explicitly_requested_browser_close(
             user_message=user_message,
             instruction=instruction,
             command_args=command_args,
         ):
-            return json.dumps({
+            return {
                 "ok": False,
                 "error": (
                     "Blocked browser close: keep browser running unless the user "
                     "explicitly requests shutdown."
                 ),
-            }, ensure_ascii=False)
+            }
 
         executed_command = command
 
@@ -1898,12 +3085,12 @@ def _handle_run_browser_task(
                 task_parts.append(instruction)
             if context_text:
                 task_parts.append(f"Context: {context_text}")
-            run_task = "\n\n".join(part for part in task_parts if part).strip()
+            run_task = "\n\n".join(filter(None, task_parts))
             if not run_task:
-                return json.dumps({
+                return {
                     "ok": False,
                     "error": "Missing run task. Provide `instruction` or `command_args`.",
-                }, ensure_ascii=False)
+                }
             command_args = [run_task]
 
         cmd.append(command)
@@ -1912,10 +3099,10 @@ def _handle_run_browser_task(
             cmd += ["--max-steps", str(max_steps)]
     else:
         if not instruction and not start_url:
-            return json.dumps({
+            return {
                 "ok": False,
                 "error": "Missing `instruction`, `start_url`, or `command` parameter.",
-            }, ensure_ascii=False)
+            }
 
         raw_instruction = instruction.strip()
         simple_open_request = _is_open_only_instruction(raw_instruction)
@@ -1932,29 +3119,26 @@ def _handle_run_browser_task(
                 task_parts.append(raw_instruction)
             if context_text:
                 task_parts.append(f"Context: {context_text}")
-            full_instruction = "\n\n".join(part for part in task_parts if part).strip()
+            full_instruction = "\n\n".join(filter(None, task_parts))
             if not full_instruction:
                 full_instruction = f"Open {start_url} in a new tab and stop."
             cmd += ["run", full_instruction, "--max-steps", str(max_steps)]
 
-    env = os.environ.copy()
-    if not str(env.get("BROWSER_USE_API_KEY") or "").strip():
-        openai_key = str(env.get("OPENAI_API_KEY") or "").strip()
-        if openai_key:
-            env["BROWSER_USE_API_KEY"] = openai_key
+    env = _browser_env()
 
     _session_was_reset = False
     for _attempt in range(2):
+        # Any command may open or close the session; re-poll afterwards.
+        _forget_browser_session_state(session_name)
         try:
             proc = subprocess.run(
                 cmd,
                 capture_output=True,
-                text=True,
                 timeout=BROWSER_TOOL_TIMEOUT_SECONDS,
                 env=env,
             )
-            raw = proc.stdout.strip()
-            stderr = proc.stderr.strip()
+            raw = proc.stdout.decode("utf-8", errors="replace").strip()
+            stderr = proc.stderr.decode("utf-8", errors="replace").strip()
 
             if raw:
                 normalized = _normalize_browser_use_cli_response(raw, returncode=proc.returncode)
@@ -1975,7 +3159,7 @@ def _handle_run_browser_task(
                         start_url=start_url,
                         env=env,
                     )
-                    return json.dumps(normalized, ensure_ascii=False)
+                    return normalized
 
             if proc.returncode == 0:
                 out = {
@@ -1992,42 +3176,48 @@ def _handle_run_browser_task(
                     start_url=start_url,
                     env=env,
                 )
-                return json.dumps(out, ensure_ascii=False)
+                return out
             else:
                 error_text = stderr[:1500] or raw[:1500] or f"Exit code {proc.returncode}"
                 if not _session_was_reset and _is_browser_session_corrupt(error_text):
                     _reset_browser_session(session_name, env)
                     _session_was_reset = True
                     continue
-                return json.dumps({
+                return {
                     "ok": False,
                     "error": "browser-use command failed",
                     "details": error_text,
-                }, ensure_ascii=False)
+                }
 
         except subprocess.TimeoutExpired:
-            return json.dumps({
+            return {
                 "ok": False,
                 "error": f"Browser task timed out after {BROWSER_TOOL_TIMEOUT_SECONDS}s",
                 "details": "The browser session is still running. You can interact with it manually.",
-            }, ensure_ascii=False)
+            }
         except FileNotFoundError:
-            return json.dumps({
+            return {
                 "ok": False,
                 "error": "browser-use CLI not found. Install with: uv pip install 'browser-use[cli]'",
-            }, ensure_ascii=False)
+            }
         except Exception as exc:
-            return json.dumps(
-                {"ok": False, "error": "Browser task failed", "details": str(exc)},
-                ensure_ascii=False,
-            )
+            return {"ok": False, "error": "Browser task failed", "details": str(exc)}
 
     # Both attempts failed (should only reach here after corrupt-session retry)
-    return json.dumps({
+    return {
         "ok": False,
         "error": "browser-use command failed after session reset",
         "details": "The browser session was corrupt and recovery did not help.",
-    }, ensure_ascii=False)
+    }
+
+
+def _handle_run_browser_task(
+    args: dict[str, Any],
+    *,
+    screenshots: dict[str, bytes] | None = None,
+    user_message: str = "",
+) -> str:
+    return _json_dumps(_run_browser_task(args, screenshots=screenshots, user_message=user_message))
 
 
 def _with_browser_session_persistence_note(
@@ -2090,7 +3280,7 @@ def _ensure_browser_session_persisted(
     if _browser_session_is_running(session_name, env=env):
         return None
 
-    reopen_cmd: list[str] = ["uvx", "browser-use[cli]", "--json"]
+    reopen_cmd: list[str] = [*_browser_use_cli(), "--json"]
     if headed:
         reopen_cmd.append("--headed")
     reopen_cmd += ["--session", session_name]
@@ -2104,7 +3294,6 @@ def _ensure_browser_session_persisted(
         proc = subprocess.run(
             reopen_cmd,
             capture_output=True,
-            text=True,
             timeout=min(BROWSER_TOOL_TIMEOUT_SECONDS, 90),
             env=env,
         )
@@ -2112,37 +3301,78 @@ def _ensure_browser_session_persisted(
         return f"Could not re-open browser session '{session_name}': {exc}"
 
     if proc.returncode == 0:
+        _remember_browser_session_state(session_name, True)
         return f"Session '{session_name}' was re-opened to keep the browser alive."
 
-    details = (proc.stderr or proc.stdout or "").strip()
+    details = (proc.stderr or proc.stdout).decode("utf-8", errors="replace").strip()
     if details:
         return f"Could not re-open browser session '{session_name}': {details[:300]}"
     return f"Could not re-open browser session '{session_name}'."
 
 
+_browser_session_state: dict[str, tuple[float, bool]] = {}
+_browser_session_state_lock = threading.Lock()
+
+
+def _remember_browser_session_state(session_name: str, running: bool) -> None:
+    with _browser_session_state_lock:
+        _browser_session_state[session_name] = (time.monotonic(), running)
+
+
+def _forget_browser_session_state(session_name: str) -> None:
+    with _browser_session_state_lock:
+        _browser_session_state.pop(session_name, None)
+
+
+_browser_session_locks: dict[str, threading.Lock] = {}
+
+
+def _browser_session_lock(session_name: str) -> threading.Lock:
+    """Lock for one browser-use session; tasks on other sessions run concurrently."""
+    with _browser_session_state_lock:
+        return _browser_session_locks.setdefault(session_name, threading.Lock())
+
+
 def _browser_session_is_running(session_name: str, *, env: dict[str, str]) -> bool:
-    """Best-effort check for whether a named browser-use session is active."""
+    """Best-effort check for whether a named browser-use session is active.
+
+    Successful polls are reused for BROWSER_SESSION_STATE_TTL_SECONDS so
+    back-to-back checks share one `sessions` call.
+    """
+    with _browser_session_state_lock:
+        cached = _browser_session_state.get(session_name)
+    if cached is not None and time.monotonic() - cached[0] < BROWSER_SESSION_STATE_TTL_SECONDS:
+        return cached[1]
+
+    running = _poll_browser_session_running(session_name, env=env)
+    if running is None:
+        return False
+    _remember_browser_session_state(session_name, running)
+    return running
+
+
+def _poll_browser_session_running(session_name: str, *, env: dict[str, str]) -> bool | None:
+    """Ask browser-use whether a session is active; None if the poll itself failed."""
     try:
         proc = subprocess.run(
-            ["uvx", "browser-use[cli]", "--json", "sessions"],
+            [*_browser_use_cli(), "--json", "sessions"],
             capture_output=True,
-            text=True,
             timeout=20,
             env=env,
         )
     except Exception:
-        return False
+        return None
 
     if proc.returncode != 0:
-        return False
+        return None
 
-    raw = (proc.stdout or "").strip()
+    raw = proc.stdout.strip()
     if not raw:
         return False
 
     try:
-        parsed = json.loads(raw)
-    except json.JSONDecodeError:
+        parsed = _json_loads(raw)
+    except ValueError:
         return False
 
     sessions: list[Any] = []
@@ -2174,7 +3404,7 @@ def _browser_session_is_running(session_name: str, *, env: dict[str, str]) -> bo
 def _normalize_browser_use_cli_response(raw: str, *, returncode: int) -> dict[str, Any] | None:
     """Normalize browser-use JSON output to Iris' {ok, result/error} shape."""
     try:
-        parsed = json.loads(raw)
+        parsed = _json_loads(raw)
     except json.JSONDecodeError:
         return None
     if not isinstance(parsed, dict):
@@ -2241,7 +3471,7 @@ def _normalize_browser_use_cli_response(raw: str, *, returncode: int) -> dict[st
 
         final_result = str(data.get("result") or data.get("message") or "").strip()
         if not final_result and not url and data:
-            final_result = json.dumps(data, ensure_ascii=False)[:2000]
+            final_result = _json_dumps(data)[:2000]
         if final_result:
             result["final_result"] = final_result
         if request_id:
@@ -2258,14 +3488,16 @@ def _normalize_browser_use_cli_response(raw: str, *, returncode: int) -> dict[st
     return {"ok": True, "result": result}
 
 
-def _browser_tool_final_text(result_json: str) -> str:
+def _browser_tool_final_text(result_json: dict[str, Any] | str) -> str:
     """Create a deterministic final assistant message from browser tool output."""
-    normalized = _normalize_browser_use_cli_response(result_json, returncode=0)
-    if isinstance(normalized, dict):
+    if isinstance(result_json, dict):
+        # Already-normalized payload from _run_browser_task; nothing to parse.
+        parsed = result_json
+    elif isinstance(normalized := _normalize_browser_use_cli_response(result_json, returncode=0), dict):
         parsed = normalized
     else:
         try:
-            parsed = json.loads(result_json)
+            parsed = _json_loads(result_json)
         except json.JSONDecodeError:
             parsed = {"ok": False, "error": "Browser service returned invalid JSON"}
 
@@ -2305,6 +3537,11 @@ def _browser_tool_final_text(result_json: str) -> str:
     return "Completed browser task on your Mac browser."
 
 
+# Substring matches on purpose, so "closing"/"tabs" still count.
+_CLOSE_VERB_RE = re.compile(r"close|quit|exit|shutdown|shut down|terminate")
+_BROWSER_NOUN_RE = re.compile(r"browser|tab|session|window")
+
+
 def _user_explicitly_requested_browser_close(
     *, user_message: str, instruction: str, command_args: list[str]
 ) -> bool:
@@ -2315,28 +3552,39 @@ def _user_explicitly_requested_browser_close(
     if not combined:
         return False
 
-    has_close_verb = any(verb in combined for verb in (
-        "close", "quit", "exit", "shutdown", "shut down", "terminate",
-    ))
-    has_browser_object = any(noun in combined for noun in (
-        "browser", "tab", "session", "window",
-    ))
-    return has_close_verb and has_browser_object
+    return (
+        _CLOSE_VERB_RE.search(combined) is not None
+        and _BROWSER_NOUN_RE.search(combined) is not None
+    )
+
+
+_HTTP_URL_RE = re.compile(r"https?://\S+", re.IGNORECASE)
+_BARE_URL_RE = re.compile(r"\b((?:[a-zA-Z0-9-]+\.)+[a-zA-Z]{2,})(/\S*)?\b")
 
 
 def _infer_url_from_text(text: str) -> str | None:
     raw = str(text or "").strip()
     if not raw:
         return None
-    http_match = re.search(r"https?://\\S+", raw, flags=re.IGNORECASE)
-    if http_match:
-        return http_match.group(0).rstrip(".,)")
-    bare_match = re.search(r"\\b([a-zA-Z0-9-]+\\.[a-zA-Z]{2,})(/\\S*)?\\b", raw)
+    # Most instructions carry no scheme at all; skip the http scan for them.
+    if "://" in raw:
+        http_match = _HTTP_URL_RE.search(raw)
+        if http_match:
+            return http_match.group(0).rstrip(".,)")
+    bare_match = _BARE_URL_RE.search(raw)
     if bare_match:
         return f"https://{bare_match.group(0).rstrip('.,)')}"
     return None
 
 
+# Leading "open "/"navigate to ", or "go to" as a standalone phrase anywhere.
+_OPEN_PHRASE_RE = re.compile(r"^(?:open|navigate to) |(?:^| )go to(?: |$)")
+_FOLLOWUP_ACTION_RE = re.compile(
+    r"\b(and|then|after|click|tap|select|search|find|type|enter|fill|submit|"
+    r"login|log in|sign in|scroll|extract|scrape|download|bookmark|vote|post|comment)\b"
+)
+
+
 def _is_open_only_instruction(instruction: str) -> bool:
     """True only for pure navigation requests (open/go-to/navigate-to) with no follow-up actions."""
     raw = str(instruction or "").strip()
@@ -2344,37 +3592,51 @@ def _is_open_only_instruction(instruction: str) -> bool:
         return True
 
     lower = raw.lower()
-    has_open_phrase = (
-        lower.startswith("open ")
-        or lower.startswith("go to ")
-        or lower.startswith("navigate to ")
-        or " go to " in f" {lower} "
-    )
-    if not has_open_phrase:
+    if _OPEN_PHRASE_RE.search(lower) is None:
         return False
 
     # If the user asks for any additional action, this is not open-only.
-    has_followup_action = bool(re.search(
-        r"\b(and|then|after|click|tap|select|search|find|type|enter|fill|submit|"
-        r"login|log in|sign in|scroll|extract|scrape|download|bookmark|vote|post|comment)\b",
-        lower,
-    ))
-    return not has_followup_action
+    return _FOLLOWUP_ACTION_RE.search(lower) is None
+
+
+def _prepare_vision_file(file_path: Path, max_edge: int) -> tuple[str, str]:
+    """`_prepare_vision_image` for a screenshot on disk.
+
+    Without Pillow the file is sent as-is, so it is base64-encoded in chunks
+    instead of holding the raw bytes and their encoding at once.
+    """
+    if Image is None:
+        with file_path.open("rb") as fh:
+            head = fh.read(16)
+            fh.seek(0)
+            return _guess_image_media_type(head), "".join(_b64_file_chunks(fh))
+    return _prepare_vision_image(file_path.read_bytes(), max_edge)
+
+
+_IMAGE_MAGIC = {
+    b"\x89PNG\r\n\x1a\n": "image/png",
+    b"GIF87a": "image/gif",
+    b"GIF89a": "image/gif",
+    b"\xff\xd8\xff": "image/jpeg",
+}
+_IMAGE_MAGIC_LENGTHS = tuple(sorted({len(magic) for magic in _IMAGE_MAGIC}, reverse=True))
 
 
 def _guess_image_media_type(raw: bytes) -> str:
     """Infer image media type from magic bytes."""
-    if raw.startswith(b"\xff\xd8\xff"):
-        return "image/jpeg"
-    if raw.startswith(b"\x89PNG\r\n\x1a\n"):
-        return "image/png"
-    if raw.startswith(b"GIF87a") or raw.startswith(b"GIF89a"):
-        return "image/gif"
-    if raw.startswith(b"RIFF") and raw[8:12] == b"WEBP":
+    for length in _IMAGE_MAGIC_LENGTHS:
+        media_type = _IMAGE_MAGIC.get(raw[:length])
+        if media_type is not None:
+            return media_type
+    if raw[:4] == b"RIFF" and raw[8:12] == b"WEBP":
         return "image/webp"
     return "image/png"
 
 
+_describe_inflight: dict[str, Future[dict[str, Any]]] = {}
+_describe_inflight_lock = threading.Lock()
+
+
 def describe_screenshot_with_gemini(
     file_path: Path,
     mime_type: str,
@@ -2383,54 +3645,107 @@ def describe_screenshot_with_gemini(
     previous_description: dict[str, Any] | None = None,
 ) -> dict[str, Any]:
     """Return a stable JSON description for proactive screenshot monitoring."""
-    api_key = (
-        os.environ.get("GEMINI_API_KEY", "").strip()
-        or os.environ.get("GOOGLE_API_KEY", "").strip()
-    )
+    api_key = _provider_env().gemini_api_key
     if not api_key:
         raise RuntimeError("GEMINI_API_KEY or GOOGLE_API_KEY is not set")
 
-    model = os.environ.get("PROACTIVE_GEMINI_MODEL", DEFAULT_GEMINI_MODEL).strip() or DEFAULT_GEMINI_MODEL
-    data_b64 = base64.b64encode(file_path.read_bytes()).decode("ascii")
-    snapshot_json = json.dumps(coordinate_snapshot or {}, ensure_ascii=False)
-    previous_json = json.dumps(previous_description or {}, ensure_ascii=False)
+    model = _provider_env().proactive_gemini_model
+
+    # Devices in a burst often ask about the same screenshot and context at
+    # once; only the first request calls Gemini and the rest share its result.
+    st = file_path.stat()
+    key = hashlib.blake2b(_json_dumpb([
+        str(file_path), st.st_mtime_ns, st.st_size, mime_type, model,
+        coordinate_snapshot, previous_description,
+    ]), digest_size=16).hexdigest()
+    with _describe_inflight_lock:
+        future = _describe_inflight.get(key)
+        owner = future is None
+        if owner:
+            future = _describe_inflight[key] = Future()
+    if not owner:
+        return future.result()
 
-    prompt = (
-        "Analyze this iPad canvas screenshot for proactive widget opportunities. "
-        "Return JSON only. Keep keys and structure consistent across images.\n\n"
-        "Required schema:\n"
-        "{"
-        "\"schema_version\":\"1.0\","
-        "\"scene_summary\":\"string\","
-        "\"problem_to_solve\":\"string\","
-        "\"task_objective\":\"string\","
-        "\"success_criteria\":[\"string\"],"
-        "\"canvas_state\":{\"is_blank\":bool,\"density\":\"low|medium|high\",\"primary_mode\":\"drawing|text|mixed|unknown\"},"
-        "\"regions\":[{\"id\":\"r1\",\"label\":\"string\",\"kind\":\"text|diagram|list|table|equation|ui|unknown\","
-        "\"bbox_norm\":{\"x\":0..1,\"y\":0..1,\"w\":0..1,\"h\":0..1},\"salience\":0..1}],"
-        "\"suggestion_candidates\":[{\"id\":\"s1\",\"title\":\"string\",\"summary\":\"string\","
-        "\"anchor_norm\":{\"x\":0..1,\"y\":0..1},\"confidence\":0..1}],"
-        "\"change_assessment\":{\"novelty_vs_previous\":0..1,\"notable_changes\":[\"string\"]}"
-        "}\n\n"
-        "Rules:\n"
-        "- Use normalized coordinates in [0,1].\n"
-        "- Include at most 6 regions and 6 suggestion_candidates.\n"
-        "- If no candidate exists, return an empty suggestion_candidates array.\n"
-        "- problem_to_solve and task_objective must be concrete, action-guiding strings.\n"
-        "- success_criteria should be 1-4 concise bullets.\n"
-        "- Do not add extra top-level keys.\n\n"
-        f"Coordinate snapshot: {snapshot_json}\n"
-        f"Previous description: {previous_json}\n"
-    )
+    try:
+        description = _describe_screenshot_with_gemini(
+            file_path,
+            mime_type,
+            model=model,
+            api_key=api_key,
+            coordinate_snapshot=coordinate_snapshot,
+            previous_description=previous_description,
+        )
+    except BaseException as exc:
+        future.set_exception(exc)
+        raise
+    else:
+        future.set_result(description)
+        return description
+    finally:
+        with _describe_inflight_lock:
+            _describe_inflight.pop(key, None)
+
+
+# Static part of the describe request; only the two JSON tails vary per call.
+# The dicts are shared across requests and must not be mutated.
+_PROACTIVE_PROMPT_HEADER = (
+    "Analyze this iPad canvas screenshot for proactive widget opportunities. "
+    "Return JSON only. Keep keys and structure consistent across images.\n\n"
+    "Required schema:\n"
+    "{"
+    "\"schema_version\":\"1.0\","
+    "\"scene_summary\":\"string\","
+    "\"problem_to_solve\":\"string\","
+    "\"task_objective\":\"string\","
+    "\"success_criteria\":[\"string\"],"
+    "\"canvas_state\":{\"is_blank\":bool,\"density\":\"low|medium|high\",\"primary_mode\":\"drawing|text|mixed|unknown\"},"
+    "\"regions\":[{\"id\":\"r1\",\"label\":\"string\",\"kind\":\"text|diagram|list|table|equation|ui|unknown\","
+    "\"bbox_norm\":{\"x\":0..1,\"y\":0..1,\"w\":0..1,\"h\":0..1},\"salience\":0..1}],"
+    "\"suggestion_candidates\":[{\"id\":\"s1\",\"title\":\"string\",\"summary\":\"string\","
+    "\"anchor_norm\":{\"x\":0..1,\"y\":0..1},\"confidence\":0..1}],"
+    "\"change_assessment\":{\"novelty_vs_previous\":0..1,\"notable_changes\":[\"string\"]}"
+    "}\n\n"
+    "Rules:\n"
+    "- Use normalized coordinates in [0,1].\n"
+    "- Include at most 6 regions and 6 suggestion_candidates.\n"
+    "- If no candidate exists, return an empty suggestion_candidates array.\n"
+    "- problem_to_solve and task_objective must be concrete, action-guiding strings.\n"
+    "- success_criteria should be 1-4 concise bullets.\n"
+    "- Do not add extra top-level keys.\n\n"
+    "Coordinate snapshot: "
+)
+_PROACTIVE_SYSTEM_INSTRUCTION = {
+    "parts": [{
+        "text": "You are a strict vision parser. Return valid JSON only, matching the provided schema.",
+    }],
+}
+_PROACTIVE_GENERATION_CONFIG = {
+    "temperature": 0.1,
+    "responseMimeType": "application/json",
+}
+
+
+def _describe_screenshot_with_gemini(
+    file_path: Path,
+    mime_type: str,
+    *,
+    model: str,
+    api_key: str,
+    coordinate_snapshot: dict[str, Any] | None,
+    previous_description: dict[str, Any] | None,
+) -> dict[str, Any]:
+    # Downscaled WebP keeps normalized coordinates intact while cutting the
+    # payload and vision tokens; without Pillow the original bytes are sent.
+    media_type, data_b64 = _prepare_vision_file(file_path, PROACTIVE_VISION_MAX_EDGE)
+    if media_type == "image/webp":
+        mime_type = media_type
+    snapshot_json = _json_dumps(coordinate_snapshot or {})
+    previous_json = _json_dumps(previous_description or {})
+
+    prompt = f"{_PROACTIVE_PROMPT_HEADER}{snapshot_json}\nPrevious description: {previous_json}\n"
 
     body = {
-        "system_instruction": {
-            "parts": [{
-                "text": (
-                    "You are a strict vision parser. Return valid JSON only, matching the provided schema."
-                )
-            }]
-        },
+        "system_instruction": _PROACTIVE_SYSTEM_INSTRUCTION,
         "contents": [{
             "role": "user",
             "parts": [
@@ -2438,26 +3753,35 @@ def describe_screenshot_with_gemini(
                 {"inline_data": {"mime_type": mime_type or "image/png", "data": data_b64}},
             ],
         }],
-        "generationConfig": {
-            "temperature": 0.1,
-            "responseMimeType": "application/json",
-        },
+        "generationConfig": _PROACTIVE_GENERATION_CONFIG,
     }
 
-    raw = _gemini_post(model, body, api_key)
+    # Stream the reply and hang up as soon as the JSON object is complete,
+    # instead of waiting for the trailing chunks of the full response.
+    received: list[str] = []
+    closed = False
+
+    def on_text(text: str) -> None:
+        nonlocal closed
+        received.append(text)
+        if "}" in text:
+            closed = _extract_first_json_object("".join(received)) is not None
+
+    raw = _gemini_stream(model, body, api_key, on_text=on_text, stop=lambda: closed)
     text = _extract_gemini_text(raw)
     parsed = _parse_json_object(text)
     return _normalize_proactive_description(parsed)
 
 
 def _analyze_screenshot_with_openai(file_path: Path, row: dict[str, Any], question: str) -> str:
-    api_key = os.environ.get("OPENAI_API_KEY", "").strip()
+    api_key = _provider_env().openai_api_key
     if not api_key:
         return "OPENAI_API_KEY not set; only screenshot metadata available."
 
-    mime = str(row.get("mime_type") or "image/png")
-    image_b64 = base64.b64encode(file_path.read_bytes()).decode("ascii")
-    vision_model = os.environ.get("OPENAI_VISION_MODEL", "gpt-4.1-mini").strip() or "gpt-4.1-mini"
+    # Re-encoded at full size (pixel coordinates must match the original):
+    # a WebP screenshot is a fraction of the PNG, and so is its base64 body.
+    mime, image_b64 = _prepare_vision_file(file_path, WEBP_MAX_EDGE)
+    vision_model = _provider_env().openai_vision_model
 
     prompt = (
         "Analyze the screenshot for spatial placement. "
@@ -2466,7 +3790,7 @@ def _analyze_screenshot_with_openai(file_path: Path, row: dict[str, Any], questi
         f"Question: {question}"
     )
 
-    client = OpenAI(api_key=api_key)
+    client = _openai_client(api_key)
     resp = client.chat.completions.create(
         model=vision_model,
         messages=[
@@ -2484,22 +3808,52 @@ def _analyze_screenshot_with_openai(file_path: Path, row: dict[str, Any], questi
 
 
 def _extract_gemini_text(payload: dict[str, Any]) -> str:
+    """Return the first text part across candidates, or "" for malformed payloads."""
     candidates = payload.get("candidates")
-    if not isinstance(candidates, list):
+    if type(candidates) is not list:
         return ""
-    for candidate in candidates:
-        if not isinstance(candidate, dict):
-            continue
-        content = candidate.get("content")
-        if not isinstance(content, dict):
-            continue
-        parts = content.get("parts")
-        if not isinstance(parts, list):
-            continue
-        for part in parts:
-            if isinstance(part, dict) and isinstance(part.get("text"), str):
-                return part["text"]
-    return ""
+    return next(
+        (
+            text
+            for candidate in candidates
+            if type(candidate) is dict
+            and type(content := candidate.get("content")) is dict
+            and type(parts := content.get("parts")) is list
+            for part in parts
+            if type(part) is dict and type(text := part.get("text")) is str
+        ),
+        "",
+    )
+
+
+_JSON_SCAN_RE = re.compile(r'[{}"\\]')
+
+
+def _extract_first_json_object(txt: str) -> str | None:
+    """Slice out the first brace-balanced {...} in txt, skipping braces inside strings."""
+    start = txt.find("{")
+    if start == -1:
+        return None
+    depth = 0
+    in_string = False
+    pos = start
+    while (match := _JSON_SCAN_RE.search(txt, pos)) is not None:
+        ch = match.group()
+        pos = match.end()
+        if in_string:
+            if ch == "\\":
+                pos += 1  # skip the escaped character
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == "{":
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+            if depth == 0:
+                return txt[start:pos]
+    return None
 
 
 def _parse_json_object(text: str) -> dict[str, Any]:
@@ -2507,16 +3861,25 @@ def _parse_json_object(text: str) -> dict[str, Any]:
     if not txt:
         raise RuntimeError("Gemini returned empty JSON text")
     try:
-        obj = json.loads(txt)
+        obj = _json_loads(txt)
         if isinstance(obj, dict):
             return obj
     except json.JSONDecodeError:
         pass
+    # Prose around the JSON: parse exactly the first balanced object.
+    candidate = _extract_first_json_object(txt)
+    if candidate is not None:
+        try:
+            obj = _json_loads(candidate)
+            if isinstance(obj, dict):
+                return obj
+        except json.JSONDecodeError:
+            pass
     start = txt.find("{")
     end = txt.rfind("}")
     if start >= 0 and end > start:
         try:
-            obj = json.loads(txt[start:end + 1])
+            obj = _json_loads(txt[start:end + 1])
             if isinstance(obj, dict):
                 return obj
         except json.JSONDecodeError:
@@ -2524,6 +3887,15 @@ def _parse_json_object(text: str) -> dict[str, Any]:
     raise RuntimeError("Gemini returned invalid JSON object")
 
 
+_PROACTIVE_DENSITIES = frozenset({"low", "medium", "high"})
+_PROACTIVE_PRIMARY_MODES = frozenset({"drawing", "text", "mixed", "unknown"})
+_PROACTIVE_REGION_KINDS = frozenset({"text", "diagram", "list", "table", "equation", "ui", "unknown"})
+
+
+def _dict_or_empty(value: Any) -> dict[str, Any]:
+    return value if isinstance(value, dict) else {}
+
+
 def _normalize_proactive_description(raw: dict[str, Any]) -> dict[str, Any]:
     def _f01(value: Any, default: float = 0.0) -> float:
         try:
@@ -2531,21 +3903,21 @@ def _normalize_proactive_description(raw: dict[str, Any]) -> dict[str, Any]:
         except (TypeError, ValueError):
             return default
 
-    canvas_state = raw.get("canvas_state") if isinstance(raw.get("canvas_state"), dict) else {}
+    canvas_state = _dict_or_empty(raw.get("canvas_state"))
     density = str(canvas_state.get("density") or "low").lower()
-    if density not in {"low", "medium", "high"}:
+    if density not in _PROACTIVE_DENSITIES:
         density = "low"
     primary_mode = str(canvas_state.get("primary_mode") or "unknown").lower()
-    if primary_mode not in {"drawing", "text", "mixed", "unknown"}:
+    if primary_mode not in _PROACTIVE_PRIMARY_MODES:
         primary_mode = "unknown"
 
     regions: list[dict[str, Any]] = []
     for i, item in enumerate(raw.get("regions") or []):
         if not isinstance(item, dict):
             continue
-        bbox = item.get("bbox_norm") if isinstance(item.get("bbox_norm"), dict) else {}
+        bbox = _dict_or_empty(item.get("bbox_norm"))
         kind = str(item.get("kind") or "unknown").lower()
-        if kind not in {"text", "diagram", "list", "table", "equation", "ui", "unknown"}:
+        if kind not in _PROACTIVE_REGION_KINDS:
             kind = "unknown"
         regions.append({
             "id": str(item.get("id") or f"r{i + 1}"),
@@ -2566,7 +3938,7 @@ def _normalize_proactive_description(raw: dict[str, Any]) -> dict[str, Any]:
     for i, item in enumerate(raw.get("suggestion_candidates") or []):
         if not isinstance(item, dict):
             continue
-        anchor = item.get("anchor_norm") if isinstance(item.get("anchor_norm"), dict) else {}
+        anchor = _dict_or_empty(item.get("anchor_norm"))
         candidates.append({
             "id": str(item.get("id") or f"s{i + 1}"),
             "title": str(item.get("title") or "Suggestion"),
@@ -2580,16 +3952,16 @@ def _normalize_proactive_description(raw: dict[str, Any]) -> dict[str, Any]:
         if len(candidates) >= 6:
             break
 
-    change = raw.get("change_assessment") if isinstance(raw.get("change_assessment"), dict) else {}
+    change = _dict_or_empty(raw.get("change_assessment"))
     notable_changes_raw = change.get("notable_changes")
     notable_changes: list[str] = []
     if isinstance(notable_changes_raw, list):
-        notable_changes = [str(v) for v in notable_changes_raw if str(v).strip()][:8]
+        notable_changes = [text for v in notable_changes_raw if (text := str(v)).strip()][:8]
 
     success_criteria_raw = raw.get("success_criteria")
     success_criteria: list[str] = []
     if isinstance(success_criteria_raw, list):
-        success_criteria = [str(v) for v in success_criteria_raw if str(v).strip()][:4]
+        success_criteria = [text for v in success_criteria_raw if (text := str(v)).strip()][:4]
 
     return {
         "schema_version": "1.0",
@@ -2611,67 +3983,92 @@ def _normalize_proactive_description(raw: dict[str, Any]) -> dict[str, Any]:
     }
 
 
+# Precompiled big-endian readers; unpack_from reads in place, no slice copies.
+_unpack_u16 = struct.Struct(">H").unpack_from
+_unpack_u16_pair = struct.Struct(">HH").unpack_from
+_unpack_u32_pair = struct.Struct(">II").unpack_from
+
+
 def _image_dimensions(file_path: Path, mime_type: str) -> tuple[int, int] | None:
+    """Read pixel dimensions from the PNG/JPEG header without loading the image."""
     try:
-        data = file_path.read_bytes()
+        with file_path.open("rb") as fh:
+            head = fh.read(24)
+            if mime_type == "image/png" or head.startswith(b"\x89PNG\r\n\x1a\n"):
+                # IHDR width/height always sit at bytes 16-24.
+                if len(head) >= 24:
+                    width, height = _unpack_u32_pair(head, 16)
+                    if width > 0 and height > 0:
+                        return width, height
+                return None
+
+            if mime_type in {"image/jpeg", "image/jpg"} or head[:2] == b"\xff\xd8":
+                fh.seek(2)
+                return _jpeg_dimensions(fh)
     except OSError:
         return None
+    return None
+
+
+# Start-of-frame markers carrying the image size (C4/C8/CC are not frames),
+# and SOI/EOI, which have no length field.
+_JPEG_SOF_MARKERS = frozenset({0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF})
+_JPEG_STANDALONE_MARKERS = frozenset({0xD8, 0xD9})
+
 
-    if mime_type == "image/png" or data.startswith(b"\x89PNG\r\n\x1a\n"):
-        if len(data) >= 24:
-            width = struct.unpack(">I", data[16:20])[0]
-            height = struct.unpack(">I", data[20:24])[0]
+def _jpeg_dimensions(fh: BinaryIO) -> tuple[int, int] | None:
+    """Minimal JPEG parser: walk segment headers, seeking past bodies, to the SOF."""
+    while True:
+        byte = fh.read(1)
+        if not byte:
+            return None
+        if byte != b"\xff":
+            continue
+        marker = fh.read(1)
+        while marker == b"\xff":  # fill bytes
+            marker = fh.read(1)
+        if not marker:
+            return None
+        if marker[0] in _JPEG_STANDALONE_MARKERS:
+            continue
+        seg_header = fh.read(2)
+        if len(seg_header) < 2:
+            return None
+        (seg_len,) = _unpack_u16(seg_header, 0)
+        if seg_len < 2:
+            return None
+        if marker[0] in _JPEG_SOF_MARKERS:
+            # precision (1 byte), then height and width
+            sof = fh.read(5)
+            if len(sof) < 5:
+                return None
+            height, width = _unpack_u16_pair(sof, 1)
             if width > 0 and height > 0:
                 return width, height
-        return None
+            return None
+        fh.seek(seg_len - 2, io.SEEK_CUR)
 
-    # Minimal JPEG parser (SOF segment)
-    if mime_type in {"image/jpeg", "image/jpg"} or data[:2] == b"\xff\xd8":
-        i = 2
-        while i + 9 < len(data):
-            if data[i] != 0xFF:
-                i += 1
-                continue
-            marker = data[i + 1]
-            i += 2
-            if marker in {0xD8, 0xD9}:
-                continue
-            if i + 2 > len(data):
-                break
-            seg_len = struct.unpack(">H", data[i:i + 2])[0]
-            if seg_len < 2 or i + seg_len > len(data):
-                break
-            if marker in {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}:
-                if i + 7 <= len(data):
-                    height = struct.unpack(">H", data[i + 3:i + 5])[0]
-                    width = struct.unpack(">H", data[i + 5:i + 7])[0]
-                    if width > 0 and height > 0:
-                        return width, height
-                break
-            i += seg_len
-    return None
+
+_GEMINI_ROLE_MAP = {"user": "user", "assistant": "model"}
+
+
+def _coerce_message_text(content: Any) -> str:
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "\n".join(str(item) for item in content)
+    return str(content)
 
 
 def _to_gemini_contents(messages: list[dict[str, Any]]) -> list[dict[str, Any]]:
-    out: list[dict[str, Any]] = []
-    for msg in messages:
-        role = str(msg.get("role") or "").strip()
-        if role not in {"user", "assistant"}:
-            continue
-        raw_content = msg.get("content", "")
-        if isinstance(raw_content, str):
-            text = raw_content
-        elif isinstance(raw_content, list):
-            text = "\n".join(str(item) for item in raw_content)
-        else:
-            text = str(raw_content)
-        out.append({
-            "role": "model" if role == "assistant" else "user",
-            "parts": [{"text": text}],
-        })
-    return out
+    return [
+        {"role": _GEMINI_ROLE_MAP[role], "parts": [{"text": _coerce_message_text(msg.get("content", ""))}]}
+        for msg in messages
+        if (role := str(msg.get("role") or "").strip()) in _GEMINI_ROLE_MAP
+    ]
 
 
+@lru_cache(maxsize=32)
 def _provider_for_model(model: str) -> str:
     lowered = model.lower()
     if lowered == "claude" or lowered.startswith("claude"):
@@ -2683,6 +4080,7 @@ def _provider_for_model(model: str) -> str:
     return "unknown"
 
 
+@lru_cache(maxsize=32)
 def _resolve_anthropic_model(model: str) -> str | None:
     lowered = model.lower()
     if lowered == "claude":
@@ -2695,6 +4093,29 @@ def _resolve_anthropic_model(model: str) -> str | None:
     return model
 
 
+# Title providers are raced on their own threads so they never queue behind tool calls.
+_TITLE_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="iris-title")
+
+
+def _gemini_session_title(prompt: str, api_key: str) -> str:
+    body = {
+        "contents": [{"role": "user", "parts": [{"text": prompt}]}],
+        "generationConfig": {"temperature": 0.3, "maxOutputTokens": 30},
+    }
+    data = _gemini_post(DEFAULT_GEMINI_MODEL, body, api_key)
+    return _extract_gemini_text(data).strip().strip('"\'').rstrip(".")
+
+
+def _openai_session_title(prompt: str, api_key: str) -> str:
+    client = _openai_client(api_key)
+    resp = client.chat.completions.create(
+        model="gpt-4.1-mini",
+        messages=[{"role": "user", "content": prompt}],
+        max_tokens=30,
+    )
+    return (resp.choices[0].message.content or "").strip().strip('"\'').rstrip(".")
+
+
 def generate_session_title(user_message: str) -> str:
     """Generate a brief (2-6 word) session title from the user's first message."""
     truncated = user_message.strip()[:500]
@@ -2707,39 +4128,42 @@ def generate_session_title(user_message: str) -> str:
         f"Request: {truncated}"
     )
 
-    # Try Gemini first (fastest/cheapest)
-    gemini_key = (
-        os.environ.get("GEMINI_API_KEY", "").strip()
-        or os.environ.get("GOOGLE_API_KEY", "").strip()
-    )
+    # Gemini (cheapest) goes first; OpenAI is hedged in if Gemini fails or has
+    # not answered within the hedge delay. The first usable title wins, and
+    # past the deadline the truncated message is used instead.
+    attempts: list[Callable[[], str]] = []
+    provider_env = _provider_env()
+    gemini_key = provider_env.gemini_api_key
     if gemini_key:
-        try:
-            body = {
-                "contents": [{"role": "user", "parts": [{"text": prompt}]}],
-                "generationConfig": {"temperature": 0.3, "maxOutputTokens": 30},
-            }
-            data = _gemini_post(DEFAULT_GEMINI_MODEL, body, gemini_key)
-            text = _extract_gemini_text(data).strip().strip('"\'').rstrip(".")
-            if text:
-                return text
-        except Exception:
-            pass
-
-    # Try OpenAI fallback
-    openai_key = os.environ.get("OPENAI_API_KEY", "").strip()
+        attempts.append(partial(_gemini_session_title, prompt, gemini_key))
+    openai_key = provider_env.openai_api_key
     if openai_key:
-        try:
-            client = OpenAI(api_key=openai_key)
-            resp = client.chat.completions.create(
-                model="gpt-4.1-mini",
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=30,
-            )
-            text = (resp.choices[0].message.content or "").strip().strip('"\'').rstrip(".")
-            if text:
-                return text
-        except Exception:
-            pass
+        attempts.append(partial(_openai_session_title, prompt, openai_key))
+
+    started = time.monotonic()
+    deadline = started + SESSION_TITLE_DEADLINE_SECONDS
+    hedge_at = started + SESSION_TITLE_HEDGE_DELAY_SECONDS
+    pending: set[Future[str]] = set()
+    try:
+        while attempts or pending:
+            now = time.monotonic()
+            if attempts and (not pending or now >= hedge_at):
+                pending.add(_TITLE_EXECUTOR.submit(attempts.pop(0)))
+                continue
+            if now >= deadline:
+                break
+            wake_at = min(deadline, hedge_at) if attempts else deadline
+            done, pending = wait(pending, timeout=wake_at - now, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    text = future.result()
+                except Exception:
+                    continue
+                if text:
+                    return text
+    finally:
+        for future in pending:
+            future.cancel()
 
     # Fallback: truncate message
     clean = user_message.strip()
@@ -2748,6 +4172,7 @@ def generate_session_title(user_message: str) -> str:
     return clean or "Untitled"
 
 
+@lru_cache(maxsize=32)
 def _resolve_gemini_model(model: str) -> str:
     lowered = model.lower()
     if lowered in {"gemini", "gemini-flash"}:
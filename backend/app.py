@@ -18,6 +18,7 @@ from datetime import datetime, timezone
 from pathlib import Path
 from typing import Any
 
+import orjson
 from flask import Flask, Response, jsonify, request, send_file, stream_with_context
 from werkzeug.utils import secure_filename
 
@@ -1042,6 +1043,13 @@ def _execute_linked_provider(
 # ---------------------------------------------------------------------------
 
 
+# Screenshot rows by id, read from disk on first use and then kept in step by
+# _save_screenshot/_delete_screenshot_row, so listing and pruning (which runs
+# on every upload) never rescan the metadata directory.
+_screenshot_index: dict[str, dict] | None = None
+_screenshot_index_lock = threading.Lock()
+
+
 def _screenshot_meta_path(screenshot_id: str) -> Path:
     return SCREENSHOTS_META_DIR / f"{screenshot_id}.json"
 
@@ -1059,18 +1067,41 @@ def _save_screenshot(row: dict) -> None:
     tmp = path.with_suffix(".json.tmp")
     tmp.write_text(json.dumps(row, ensure_ascii=False))
     tmp.replace(path)
+    with _screenshot_index_lock:
+        if _screenshot_index is not None:
+            _screenshot_index[row["id"]] = row
+
+
+def _load_screenshot_meta_file(path: Path) -> dict | None:
+    try:
+        # orjson parses the UTF-8 bytes as read, with no intermediate str.
+        data = orjson.loads(path.read_bytes())
+    except (orjson.JSONDecodeError, OSError):
+        return None
+    return data if isinstance(data, dict) else None
 
 
 def _list_screenshots() -> list[dict]:
-    rows = []
-    for p in SCREENSHOTS_META_DIR.glob("*.json"):
-        try:
-            data = json.loads(p.read_text())
-            if isinstance(data, dict):
-                rows.append(data)
-        except (json.JSONDecodeError, OSError):
-            continue
-    return rows
+    global _screenshot_index
+    with _screenshot_index_lock:
+        if _screenshot_index is None:
+            # One-time cold load; the reads are independent, so overlap them.
+            # scandir reports file types from the directory read itself, so
+            # listing costs no per-entry stat and no glob pattern matching.
+            with os.scandir(SCREENSHOTS_META_DIR) as entries:
+                paths = [
+                    Path(entry.path)
+                    for entry in entries
+                    if entry.name.endswith(".json") and entry.is_file()
+                ]
+            with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+                rows = list(pool.map(_load_screenshot_meta_file, paths))
+            _screenshot_index = {
+                str(data.get("id") or path.stem): data
+                for path, data in zip(paths, rows)
+                if data is not None
+            }
+        return list(_screenshot_index.values())
 
 
 def _save_proactive_description(payload: dict[str, Any]) -> None:
@@ -1087,6 +1118,9 @@ def _delete_screenshot_row(row: dict[str, Any]) -> None:
     screenshot_id = str(row.get("id") or "").strip()
     if screenshot_id:
         _screenshot_meta_path(screenshot_id).unlink(missing_ok=True)
+        with _screenshot_index_lock:
+            if _screenshot_index is not None:
+                _screenshot_index.pop(screenshot_id, None)
         (PROACTIVE_DESCRIPTIONS_DIR / f"{screenshot_id}.json").unlink(missing_ok=True)
 
     file_path = Path(str(row.get("file_path") or ""))